@@ -1,3 +1,16 @@
+import os
+
+from dotenv import load_dotenv
+
+# eventlet and gevent need the standard library patched before anything else is imported
+load_dotenv()
+if os.getenv('SOCKETIO_ASYNC_MODE') == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif os.getenv('SOCKETIO_ASYNC_MODE') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 from src import app_run
 from src.GPT import translate_to
 
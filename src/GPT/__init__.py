@@ -1,55 +1,275 @@
 # This class takes a language and prompt as arguments and creates an instance.
 #   gpt = ChatBot("Japanese", "You are a doctor. Ask for details about the symptoms.")
 
+import asyncio
+import threading
+import weakref
+from contextlib import ExitStack, nullcontext
+
+import httpx
 import openai
 import os
 
+from ..glovars import (
+    AI_DOCTOR_MAX_HISTORY, AI_DOCTOR_MAX_HISTORY_TOKENS, OPENAI_TIMEOUT, OPENAI_CONNECT_TIMEOUT,
+    OPENAI_MAX_CONNECTIONS, OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_MAX_CONCURRENCY, OPENAI_PURPOSE_CONCURRENCY
+)
+from .resilience import (
+    UpstreamUnavailable, call_with_retry, async_call_with_retry, record_broken_stream, get_metrics
+)
+
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+"""
+Every request goes through one pooled client, which keeps its connections alive between calls. The number of requests
+in flight is bounded globally and per purpose ('chat', 'translate', 'highlight'), see OPENAI_PURPOSE_CONCURRENCY.
+Failed calls are retried by .resilience, which raises UpstreamUnavailable when giving up.
+"""
+_client: openai.OpenAI | None = None
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()  # asyncio loop -> AsyncOpenAI
+_client_lock = threading.Lock()
+
+_semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+_purpose_semaphores = {
+    purpose: threading.BoundedSemaphore(limit) for purpose, limit in OPENAI_PURPOSE_CONCURRENCY.items()
+}
+_async_semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()  # asyncio loop -> (global, {purpose: ..})
+
 
-def send_msg_to_gpt(messages: list[dict]):
-    response = openai.chat.completions.create(
-        model="gpt-4o",  # change to gpt-4 for the most professional AI doctor
-        messages=messages,
-        temperature=0.1,
-        max_tokens=256,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0
+def _client_options() -> dict:
+    return {
+        'api_key': os.getenv("OPENAI_API_KEY"),
+        'timeout': httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        'max_retries': 0  # retried by .resilience instead
+    }
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS
     )
 
+
+def get_client() -> openai.OpenAI:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = openai.OpenAI(
+                    **_client_options(),
+                    http_client=openai.DefaultHttpxClient(limits=_pool_limits())
+                )
+
+    return _client
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """
+    Async clients are bound to the event loop they are created in, so there is one per loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            **_client_options(),
+            http_client=openai.DefaultAsyncHttpxClient(limits=_pool_limits())
+        )
+        _async_clients[loop] = client
+
+    return client
+
+
+def _completion_params(options: dict) -> dict:
+    params = {
+        'model': "gpt-4o",  # change to gpt-4 for the most professional AI doctor
+        'temperature': 0.1,
+        'max_tokens': 256,
+        'top_p': 1,
+        'frequency_penalty': 0,
+        'presence_penalty': 0
+    }
+    params.update(options)
+    return params
+
+
+def _create_completion(messages: list[dict], purpose: str, options: dict):
+    with _semaphore, _purpose_semaphores.get(purpose, nullcontext()):
+        return get_client().chat.completions.create(messages=messages, **_completion_params(options))
+
+
+def send_msg_to_gpt(messages: list[dict], purpose: str = 'chat', **options):
+    """
+    :param purpose: which concurrency limit of OPENAI_PURPOSE_CONCURRENCY applies
+    :param options: overrides of the completion parameters, e.g. max_tokens or response_format
+    :raises UpstreamUnavailable: if GPT cannot be reached
+    """
+    response = call_with_retry(_create_completion, messages, purpose, options)
+    return response.choices[0].message.content
+
+
+def stream_msg_to_gpt(messages: list[dict], purpose: str = 'chat', **options):
+    """
+    Generator version of send_msg_to_gpt, yielding the completion piece by piece as it is generated.
+    The concurrency limits are held from the opening of the stream until it ends, but not while waiting between two
+    attempts to open it. Only opening the stream is retried.
+    :raises UpstreamUnavailable: if GPT cannot be reached, or the stream breaks
+    """
+    def open_stream():
+        limits = ExitStack()
+        limits.enter_context(_semaphore)
+        limits.enter_context(_purpose_semaphores.get(purpose, nullcontext()))
+        try:
+            stream = get_client().chat.completions.create(messages=messages, stream=True,
+                                                          **_completion_params(options))
+        except BaseException:
+            limits.close()
+            raise
+
+        return limits, stream
+
+    limits, stream = call_with_retry(open_stream)
+    with limits:
+        try:
+            with stream:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        except (openai.APIError, httpx.HTTPError) as e:
+            # A broken connection surfaces as the httpx error itself
+            raise record_broken_stream(e) from e
+
+
+async def _async_create_completion(messages: list[dict], purpose: str, options: dict):
+    loop = asyncio.get_running_loop()
+    semaphores = _async_semaphores.get(loop)
+    if semaphores is None:
+        semaphores = (
+            asyncio.BoundedSemaphore(OPENAI_MAX_CONCURRENCY),
+            {name: asyncio.BoundedSemaphore(limit) for name, limit in OPENAI_PURPOSE_CONCURRENCY.items()}
+        )
+        _async_semaphores[loop] = semaphores
+
+    global_semaphore, purpose_semaphores = semaphores
+    purpose_semaphore = purpose_semaphores.get(purpose)
+    async with global_semaphore:
+        if purpose_semaphore is None:
+            return await get_async_client().chat.completions.create(messages=messages, **_completion_params(options))
+
+        async with purpose_semaphore:
+            return await get_async_client().chat.completions.create(messages=messages, **_completion_params(options))
+
+
+async def async_send_msg_to_gpt(messages: list[dict], purpose: str = 'chat', **options):
+    """
+    asyncio version of send_msg_to_gpt, with the same limits applied per event loop.
+    """
+    response = await async_call_with_retry(_async_create_completion, messages, purpose, options)
     return response.choices[0].message.content
 
 
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 ASCII characters per token, and about one token per CJK or other non-ASCII character
+    ascii_count = sum(1 for char in text if ord(char) < 128)
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
 class ChatBot:
+    """
+    Conversational bots keep their history in `messages`, bounded by `max_history` (number of messages after the
+    system prompt) and `max_history_tokens` (estimated). The oldest turns are dropped first; None means unbounded.
+    Utility bots that only need the system prompt should use `ask`, which keeps no history at all.
+    """
     first_msg_generated = False
 
-    def __init__(self, language: str = 'en', init_prompt: str = ''):
+    def __init__(self, language: str = 'en', init_prompt: str = '', max_history: int | None = None,
+                 max_history_tokens: int | None = None, purpose: str = 'chat'):
         self.lan = language
+        self.purpose = purpose
         lan_prompt = f"Please respond in the language corresponding to the language code `{self.lan}`."
         self.prompt = init_prompt + ' ' + lan_prompt
+        self.max_history = max_history
+        self.max_history_tokens = max_history_tokens
 
         self.messages = [
             {"role": "system", "content": self.prompt}
         ]
 
+    def trim_history(self):
+        """
+        Slide the history window. The system prompt and the latest message are always kept.
+        """
+        history = self.messages[1:]
+
+        if self.max_history is not None and len(history) > self.max_history:
+            history = history[-max(self.max_history, 1):]
+
+        if self.max_history_tokens is not None:
+            tokens = sum(estimate_tokens(message['content']) for message in history)
+            while len(history) > 1 and tokens > self.max_history_tokens:
+                tokens -= estimate_tokens(history.pop(0)['content'])
+
+        self.messages = [self.messages[0]] + history
+
+    def get_history(self) -> list[dict]:
+        """
+        :return: the messages after the system prompt
+        """
+        return self.messages[1:]
+
+    def set_history(self, history: list[dict]):
+        self.messages = [self.messages[0]] + history
+        self.trim_history()
+
     def gen_first_message(self):
         if self.first_msg_generated:
             raise RuntimeError('get_first_message can only be called once')
 
         self.first_msg_generated = True
-        assistant_msg = send_msg_to_gpt(self.messages)
+        assistant_msg = send_msg_to_gpt(self.messages, self.purpose)
         self.messages.append({"role": "assistant", "content": assistant_msg})
         return assistant_msg
 
     def chat(self, msg: str):
         self.messages.append({"role": "user", "content": msg})
+        self.trim_history()
 
-        assistant_msg = send_msg_to_gpt(self.messages)
+        assistant_msg = send_msg_to_gpt(self.messages, self.purpose)
         self.messages.append({"role": "assistant", "content": assistant_msg})
+        self.trim_history()
 
         return assistant_msg
 
+    def chat_stream(self, msg: str):
+        """
+        Same as chat, but yields the reply piece by piece. The reply joins the history once it is complete.
+        """
+        self.messages.append({"role": "user", "content": msg})
+        self.trim_history()
+
+        pieces = []
+        for piece in stream_msg_to_gpt(self.messages, self.purpose):
+            pieces.append(piece)
+            yield piece
+
+        self.messages.append({"role": "assistant", "content": ''.join(pieces)})
+        self.trim_history()
+
+    def ask(self, msg: str, **options):
+        """
+        One-shot call: system prompt + a single user turn. Nothing is stored, so shared bots stay stateless.
+        """
+        return send_msg_to_gpt([
+            self.messages[0],
+            {"role": "user", "content": msg}
+        ], self.purpose, **options)
+
+    async def async_ask(self, msg: str, **options):
+        return await async_send_msg_to_gpt([
+            self.messages[0],
+            {"role": "user", "content": msg}
+        ], self.purpose, **options)
+
 
 def get_ai_doctor(language_code: str):
     ai_doctor_prompt = """
@@ -88,8 +308,11 @@ give advice. If the disease is beyond your control, please strongly recommend th
 You can only ask one question at a time.
 You should only return one line of message. No return in the message is allowed.
 """
-    return ChatBot(language_code, ai_doctor_prompt)
+    return ChatBot(language_code, ai_doctor_prompt, AI_DOCTOR_MAX_HISTORY, AI_DOCTOR_MAX_HISTORY_TOKENS)
 
 
-from .translator import translate_to
-from .chat_manager import extract_medical_term, explain_medical_term
+from .translator import translate_to, translate_to_many
+from .chat_manager import (
+    extract_medical_term, explain_medical_term, analyze_medical_terms, explain_analyzed_term, find_term_url
+)
+from . import term_cache
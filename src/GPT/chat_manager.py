@@ -1,4 +1,11 @@
+import copy
+
 from . import highlighter
+from .single_flight import flights
+from .term_cache import cached_term, get_cached_term
+from .translator import normalize_text
+from .. import url_verifier
+from ..utils import print_info
 
 def extract_medical_term(lan_code, text) -> list[dict]:
     """
@@ -24,20 +31,22 @@ def extract_medical_term(lan_code, text) -> list[dict]:
     terms = highlighter.search_med_term(lan_code, text)
 
     for term in terms:
-        synonyms = highlighter.get_synonym(lan_code, term)
+        synonyms = cached_term('synonyms', lan_code, term, lambda: highlighter.get_synonym(lan_code, term))
         synonyms.append(term)
 
         termDictList.append({"term": term, "synonyms": synonyms})
 
     return termDictList
 
-def explain_medical_term(lan_code, term):
+def explain_medical_term(lan_code, term, check_url=True):
     """
     explain medical term
 
     Request:
     lan_code: string
     term: string - a medical term
+    check_url: bool - False not to wait for the URL search. The URL is then None unless already known, and should be
+        filled in later with find_term_url
 
     Response:
     {
@@ -46,14 +55,108 @@ def explain_medical_term(lan_code, term):
         "url": "https://___"
     }
     """
-    termType = highlighter.get_termType(lan_code, term)
-    termDescription = highlighter.explain_med_term(lan_code, term)
-    termUrl = highlighter.get_url(lan_code, term)
+    if not check_url:
+        cached = get_cached_term('explain', lan_code, term)
+        if cached is not None:
+            return cached
 
-    res = {
-        "type": termType,
-        "description": termDescription,
-        "url": termUrl
-    }
+        # Not cached without its URL: it is once the URL is filled in
+        return {
+            "type": highlighter.get_termType(lan_code, term),
+            "description": highlighter.explain_med_term(lan_code, term),
+            "url": get_cached_term('url', lan_code, term)
+        }
+
+    return cached_term('explain', lan_code, term, lambda: {
+        "type": highlighter.get_termType(lan_code, term),
+        "description": highlighter.explain_med_term(lan_code, term),
+        "url": cached_term('url', lan_code, term, lambda: highlighter.get_url(lan_code, term))
+    })
+
+def analyze_medical_terms(lan_code, text) -> list[dict]:
+    """
+    extract medical terms in sentences, with their explanation, in one GPT call.
+    Falls back to extract_medical_term if the batched response is invalid, in which case there is no "explanation".
+
+    Request:
+    lan_code: string
+    text: string - original sentences
+
+    Response:
+    [
+        {
+            "term": "Covid19",
+            "synonyms": ["covid-19", "Covid19"],
+            "explanation": {
+                "type": "CONDITION",
+                "description": "covid-19 is ___",
+                "url": "https://___"  # not checked yet
+            }
+        }
+    ]
+    """
+    try:
+        # Concurrent analyses of the same text share one GPT call
+        terms = copy.deepcopy(flights.do(('analyze', lan_code, normalize_text(text)),
+                                         highlighter.analyze_med_terms, lan_code, text))
+    except ValueError as e:
+        print_info(f'Falling back to per-term analysis: {e}')
+        return extract_medical_term(lan_code, text)
+
+    return [
+        {
+            "term": term['term'],
+            "synonyms": term['synonyms'],
+            "explanation": {
+                "type": term['type'],
+                "description": term['description'],
+                "url": term['url']
+            }
+        } for term in terms
+    ]
+
+def explain_analyzed_term(lan_code, term, check_url=True):
+    """
+    explain a term returned by analyze_medical_terms, only asking GPT for what the batched call did not provide
+
+    Request:
+    lan_code: string
+    term: dict - an item of analyze_medical_terms
+    check_url: bool - False not to wait for the URL check. The URL is then None unless it is known to be valid, and
+        should be filled in later with find_term_url
+
+    Response: same as explain_medical_term
+    """
+    cached = get_cached_term('explain', lan_code, term['term'])
+    if cached is not None:
+        return cached
+
+    explanation = term.get('explanation')
+    if explanation is None:
+        return explain_medical_term(lan_code, term['term'], check_url)
+
+    if not check_url:
+        if not url_verifier.cached_result(explanation['url']):
+            explanation['url'] = None
+        return explanation
+
+    return cached_term('explain', lan_code, term['term'], lambda: {
+        **explanation,
+        "url": find_term_url(lan_code, term['term'], explanation['url'])
+    })
+
+def find_term_url(lan_code, term, candidate_url=None):
+    """
+    the candidate URL if it is valid, otherwise one found by GPT
+
+    Request:
+    lan_code: string
+    term: string - a medical term
+    candidate_url: string - e.g. the URL given by analyze_medical_terms
+
+    Response: "https://___", or "None" if no valid URL is found
+    """
+    if candidate_url and url_verifier.check_url(candidate_url):
+        return candidate_url
 
-    return res
+    return cached_term('url', lan_code, term, lambda: highlighter.get_url(lan_code, term))
@@ -3,11 +3,11 @@
 # Use "search_med_term" method to obtain a response from gpt for medical term extraction.
 # Use "explain_med_term" method to get an explanation of medical terms.
 
-# do we need history?
+# No history is needed: the per-language bots below are only called one-shot with ChatBot.ask
 import json
 
-import urllib.request
 from . import ChatBot
+from .. import url_verifier
 #from .translator import translate_to
 
 import openai
@@ -22,6 +22,9 @@ typeGetters: dict[str, ChatBot] = {}
 explainers: dict[str, ChatBot] = {}
 urlGetters: dict[str, ChatBot] = {}
 wikiUrlGetters: dict[str, ChatBot] = {}
+analyzers: dict[str, ChatBot] = {}
+
+TERM_TYPES = ('CONDITION', 'PRESCRIPTION', 'GENERAL')
 
 
 def search_med_term(lan_code, text, error="None"):
@@ -38,10 +41,10 @@ If there are no medical terms or unexpected input occurs, output {error}.
     extractor = extractors.get(lan_code)
 
     if extractor is None:
-        extractor = ChatBot(lan_code, prompt)
+        extractor = ChatBot(lan_code, prompt, purpose='highlight')
         extractors[lan_code] = extractor
 
-    res = extractor.chat(text)
+    res = extractor.ask(text)
 
     if res == error:
         return []
@@ -53,7 +56,7 @@ def get_synonym(lan_code, term, error="None"):
     global synonymGetters
 
     prompt_syn = f"""
-List synonyms that have the same meaning as {term} in {lan_code}.
+List synonyms that have the same meaning as the following medical term in {lan_code}.
 Output in the list format like synonymA,synonymB,synonymC.
 No more extra output. Just simply list output.
 If there are no synonyms terms or unexpected input occurs, output {error}.
@@ -61,10 +64,10 @@ If there are no synonyms terms or unexpected input occurs, output {error}.
     synonymGetter = synonymGetters.get(lan_code)
 
     if synonymGetter is None:
-        synonymGetter = ChatBot(lan_code, prompt_syn)
+        synonymGetter = ChatBot(lan_code, prompt_syn, purpose='highlight')
         synonymGetters[lan_code] = synonymGetter
 
-    res = synonymGetter.chat(term)
+    res = synonymGetter.ask(term)
 
     if res == error:
         return []
@@ -82,10 +85,10 @@ If another unexpected input occurs like a sentence, output {error}.
 """
     typeGetter = typeGetters.get(lan_code)
     if typeGetter is None:
-        typeGetter = ChatBot(lan_code, prompt_type)
+        typeGetter = ChatBot(lan_code, prompt_type, purpose='highlight')
         typeGetters[lan_code] = typeGetter
 
-    res = typeGetter.chat(term)
+    res = typeGetter.ask(term)
 
     return res
 
@@ -101,27 +104,16 @@ If another unexpected input occurs like a sentence, output {error}.
     explainer = explainers.get(lan_code)
 
     if explainer is None:
-        explainer = ChatBot(lan_code, prompt_exp)
+        explainer = ChatBot(lan_code, prompt_exp, purpose='highlight')
         explainers[lan_code] = explainer
 
-    res = explainer.chat(term)
+    res = explainer.ask(term)
 
     return res
 
 def check_url(url):
-    validUrl = True
-    try:
-        tmp = urllib.request.urlopen(url)
-        tmp.close()
-    except urllib.error.HTTPError as e:
-        if e.code == 403:  # Forbidden Error
-            return True
-        else:
-            return False
-    except Exception as e:
-        return False
-
-    return validUrl
+    # HEAD request with short timeouts, cached. See url_verifier
+    return url_verifier.check_url(url)
 
 def get_url(lan_code, term, error="None"):
     # chatgpt CANNOT confirm the site of link
@@ -144,10 +136,10 @@ For example, when language code is jp, inputting リウマチ熱, output https:/
 
     urlGetter = urlGetters.get(lan_code)
     if urlGetter is None:
-        urlGetter = ChatBot(lan_code, prompt_url)
+        urlGetter = ChatBot(lan_code, prompt_url, purpose='highlight')
         urlGetters[lan_code] = urlGetter
 
-    res = urlGetter.chat(term)
+    res = urlGetter.ask(term)
 
     urlstr = error
 
@@ -156,16 +148,89 @@ For example, when language code is jp, inputting リウマチ熱, output https:/
     else:
         wikiUrlGetter = wikiUrlGetters.get(lan_code)
         if wikiUrlGetter is None:
-            wikiUrlGetter = ChatBot(lan_code, prompt_wiki_url)
+            wikiUrlGetter = ChatBot(lan_code, prompt_wiki_url, purpose='highlight')
             wikiUrlGetters[lan_code] = wikiUrlGetter
 
-        res = wikiUrlGetter.chat(term)
+        res = wikiUrlGetter.ask(term)
 
         if check_url(res):
             urlstr = res
 
     return urlstr
 
+def analyze_med_terms(lan_code, text) -> list[dict]:
+    """
+    Extract the medical terms of the text together with their synonyms, type, explanation and a candidate URL,
+    all in a single GPT call. The URL is not checked.
+
+    Raises ValueError if the response does not follow the schema.
+
+    Response:
+    [
+        {
+            "term": "Covid19",
+            "synonyms": ["covid-19", "Covid19"],
+            "type": "CONDITION",
+            "description": "covid-19 is ___",
+            "url": "https://___"
+        }
+    ]
+    """
+    global analyzers
+
+    prompt = f"""
+You are a medical term analyzer API and you speak in JSON.
+Extract specialized medical terms from the text given by the user. Make sure to extract only what is present in the text.
+For each term, give
+- "term": the term exactly as it appears in the text,
+- "synonyms": a list of synonyms that have the same meaning in {lan_code},
+- "type": one of "CONDITION", "PRESCRIPTION" or "GENERAL",
+- "description": an explanation of the term in a simple sentence in {lan_code},
+- "url": the URL of the most reliable site that certainly explains the term in {lan_code}, preferably wikipedia, or null.
+Output only a JSON object like {{"terms": [{{"term": "...", "synonyms": ["..."], "type": "CONDITION", "description": "...", "url": "https://..."}}]}}.
+If there are no medical terms or unexpected input occurs, output {{"terms": []}}.
+"""
+    analyzer = analyzers.get(lan_code)
+
+    if analyzer is None:
+        analyzer = ChatBot(lan_code, prompt, purpose='highlight')
+        analyzers[lan_code] = analyzer
+
+    res = analyzer.ask(text, max_tokens=2048, response_format={"type": "json_object"})
+
+    try:
+        terms = json.loads(res)['terms']
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError(f'Unexpected analyzer output: {res}') from e
+
+    if not isinstance(terms, list):
+        raise ValueError(f'Unexpected analyzer output: {res}')
+
+    resList = []
+    for term in terms:
+        if not isinstance(term, dict) or not isinstance(term.get('term'), str) or not term['term'].strip():
+            raise ValueError(f'Unexpected term in analyzer output: {term}')
+
+        synonyms = term.get('synonyms') or []
+        if not isinstance(synonyms, list) or not all(isinstance(synonym, str) for synonym in synonyms):
+            raise ValueError(f'Unexpected synonyms in analyzer output: {term}')
+
+        name = term['term'].strip()
+        synonyms = [synonym.strip() for synonym in synonyms if synonym.strip() and synonym.strip() != name]
+        synonyms.append(name)
+
+        description = term.get('description')
+        url = term.get('url')
+        resList.append({
+            "term": name,
+            "synonyms": synonyms,
+            "type": term.get('type') if term.get('type') in TERM_TYPES else 'GENERAL',
+            "description": description if isinstance(description, str) else "None",
+            "url": url if isinstance(url, str) and url else "None"
+        })
+
+    return resList
+
 class Highlighter():
     def __init__(self, lan, history=[]):
         language_dict = {'en': 'English', 'ja': 'Japanese', 'jp': 'Japanese', 'cn': 'Chinese'}
@@ -0,0 +1,255 @@
+# Retries with jittered exponential backoff, and a circuit breaker, for the calls to the OpenAI API.
+#   response = call_with_retry(create_completion, messages)
+
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+
+from ..glovars import (
+    OPENAI_MAX_RETRIES, OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+)
+from ..utils import print_info
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class UpstreamUnavailable(Exception):
+    """
+    GPT could not be reached: the retries are exhausted, or the circuit is open and the call was not even tried.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, so that calls fail fast instead of piling up on a degraded
+    upstream. After `reset_timeout` seconds a single trial call is let through (half-open): its success closes the
+    circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.open_seconds = 0.0  # total time spent not closed, for the metrics
+        self.open_count = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> tuple[bool, bool]:
+        """
+        :return: whether the call may go, and whether it is the trial call, which must then be ended by
+            record_success, record_failure or end_trial
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True, False
+
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+
+            if self.state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True, True
+
+            return False, False
+
+    def end_trial(self) -> None:
+        """
+        Let another trial through, when the trial call ended without a result, e.g. interrupted.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != 'closed':
+                self.open_seconds += time.monotonic() - self.opened_at
+                print_info('GPT circuit closed.')
+
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+
+            if self.state == 'half-open':
+                self.state = 'open'
+                self.open_seconds += time.monotonic() - self.opened_at
+                self.opened_at = time.monotonic()
+            elif self.state == 'closed' and self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.open_count += 1
+                print_info(f'GPT circuit opened after {self.failures} failures.')
+
+    def current_open_seconds(self) -> float:
+        with self._lock:
+            if self.state == 'closed':
+                return self.open_seconds
+            return self.open_seconds + time.monotonic() - self.opened_at
+
+
+breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+metrics = {
+    'calls': 0,
+    'retries': 0,
+    'failures': 0,
+    'fastFailures': 0
+}
+_metrics_lock = threading.Lock()
+
+
+def count(name: str) -> None:
+    with _metrics_lock:
+        metrics[name] += 1
+
+
+def get_metrics() -> dict:
+    with _metrics_lock:
+        counts = dict(metrics)
+
+    return {
+        **counts,
+        'circuitState': breaker.state,
+        'circuitOpenCount': breaker.open_count,
+        'circuitOpenSeconds': breaker.current_open_seconds()
+    }
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+
+    return isinstance(e, openai.APIStatusError) and e.status_code in RETRYABLE_STATUS_CODES
+
+
+def retry_after(e: Exception) -> float | None:
+    """
+    Seconds the server asked us to wait, from the `retry-after-ms` or `retry-after` header.
+    """
+    response = getattr(e, 'response', None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        if value.isdigit():
+            return float(value)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, e: Exception) -> float:
+    # Full jitter, but never shorter than what the server asked for
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    requested = retry_after(e)
+    if requested is not None:
+        delay = max(delay, min(requested, OPENAI_BACKOFF_MAX))
+
+    return delay
+
+
+def _before_call() -> bool:
+    """
+    :return: whether the call is the trial of the half-open circuit
+    """
+    count('calls')
+    allowed, trial = breaker.allow()
+    if not allowed:
+        count('fastFailures')
+        raise UpstreamUnavailable('GPT circuit is open')
+
+    return trial
+
+
+def _after_failure(attempt: int, e: Exception) -> float:
+    """
+    :return: seconds to wait before the next attempt
+    """
+    breaker.record_failure()
+    if attempt >= OPENAI_MAX_RETRIES:
+        count('failures')
+        raise UpstreamUnavailable(f'GPT call failed after {attempt + 1} attempts: {e}') from e
+
+    count('retries')
+    return backoff_delay(attempt, e)
+
+
+def record_broken_stream(e: Exception) -> UpstreamUnavailable:
+    """
+    A stream that broke after it was opened is not retried, as its first pieces are already out, but it counts as a
+    failure of the upstream.
+    :return: the exception to raise
+    """
+    breaker.record_failure()
+    count('failures')
+    return UpstreamUnavailable(f'GPT stream broken: {e}')
+
+
+def call_with_retry(func, *args, **kwargs):
+    """
+    Call func, retrying on timeouts, connection errors, 429 and 5xx responses.
+    Other errors are raised as they are. Raises UpstreamUnavailable when giving up.
+    """
+    attempt = 0
+    while True:
+        trial = _before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()  # the upstream answered, the request itself is wrong
+                raise
+            delay = _after_failure(attempt, e)
+        else:
+            breaker.record_success()
+            return result
+        finally:
+            if trial:
+                # Already ended when the result is recorded, but not when the call is interrupted
+                breaker.end_trial()
+
+        time.sleep(delay)
+        attempt += 1
+
+
+async def async_call_with_retry(func, *args, **kwargs):
+    """
+    asyncio version of call_with_retry. func is a coroutine function.
+    """
+    attempt = 0
+    while True:
+        trial = _before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()
+                raise
+            delay = _after_failure(attempt, e)
+        else:
+            breaker.record_success()
+            return result
+        finally:
+            if trial:
+                breaker.end_trial()
+
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,54 @@
+# Request coalescing: while a call for a key is running, other callers of the same key wait for it and share its
+# result (or exception) instead of making the same GPT call again.
+#   explanation = flights.do(('explain', 'en', 'fever'), explain, 'fever')
+
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.coalesced = 0  # calls that were served by another one, for the metrics
+        self._calls: dict = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call func, unless a call for the same key is already running, in which case wait for it.
+        The result is shared as it is: callers that modify it should copy it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+flights = SingleFlight()
@@ -0,0 +1,104 @@
+# Memoized term enrichment: explanations (type, description, url), synonym lists and urls, by
+# (operation, language code, normalized term). Warmed up from the stored terms, see database.message_op.cache_terms.
+#   explanation = cached_term('explain', 'en', 'Fever', lambda: explain(...))
+
+import copy
+import re
+import unicodedata
+from typing import Callable
+
+from .single_flight import flights
+from ..cache import PersistentCache, hash_key
+from ..glovars import CACHE_DB_PATH, TERM_CACHE_MEMORY_SIZE, TERM_CACHE_DISK_SIZE, TERM_CACHE_TTL
+
+# Bump when the term prompts change, so that old cached results are no longer used
+TERM_PROMPT_VERSION = '1'
+
+term_cache = PersistentCache(
+    CACHE_DB_PATH,
+    'term',
+    max_memory_items=TERM_CACHE_MEMORY_SIZE,
+    max_disk_items=TERM_CACHE_DISK_SIZE,
+    ttl=TERM_CACHE_TTL
+)
+
+
+def normalize_term(term: str) -> str:
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', term)).strip().casefold()
+
+
+def term_key(operation: str, lan_code: str, term: str) -> str:
+    return hash_key(TERM_PROMPT_VERSION, operation, lan_code, normalize_term(term))
+
+
+def get_cached_term(operation: str, lan_code: str, term: str):
+    # Copied, as callers may modify what they get
+    return copy.deepcopy(term_cache.get(term_key(operation, lan_code, term)))
+
+
+def cached_term(operation: str, lan_code: str, term: str, compute: Callable):
+    """
+    The cached result of `operation` for the term, or compute() and cache it. Empty results are not cached.
+    Concurrent calls for the same term share a single compute().
+    """
+    value = get_cached_term(operation, lan_code, term)
+    if value is not None:
+        return value
+
+    key = term_key(operation, lan_code, term)
+
+    def compute_and_cache():
+        # The call that just finished may have cached it
+        value = term_cache.get(key)
+        if value is None:
+            value = compute()
+            if value:
+                term_cache.set(key, copy.deepcopy(value))
+
+        return value
+
+    return copy.deepcopy(flights.do(key, compute_and_cache))
+
+
+def store_terms(terms: list[dict], overwrite: bool = True) -> int:
+    """
+    Cache known terms, like
+    {
+        "language": "en",
+        "name": "fever",
+        "type": "CONDITION",
+        "description": "...",
+        "url": "https://...",
+        "synonyms": ["fever", "pyrexia"]
+    }
+    Explanations are cached under the name and every synonym, and synonym lists under the name.
+    :param overwrite: False to keep what is already cached, for the warm-up
+    :return: number of entries written
+    """
+    written = 0
+    for term in terms:
+        explanation = {"type": term['type'], "description": term['description'], "url": term['url']}
+        entries = [('explain', name, explanation) for name in {term['name'], *term['synonyms']}]
+        if term['synonyms']:
+            entries.append(('synonyms', term['name'], term['synonyms']))
+        if term['url']:
+            entries.append(('url', term['name'], term['url']))
+
+        for operation, name, value in entries:
+            key = term_key(operation, term['language'], name)
+            if overwrite or term_cache.get(key) is None:
+                term_cache.set(key, value)
+                written += 1
+
+    return written
+
+
+def forget_terms(terms: list[dict]) -> None:
+    """
+    Drop cached terms, given like for store_terms.
+    """
+    for term in terms:
+        for name in {term['name'], *term['synonyms']}:
+            term_cache.delete(term_key('explain', term['language'], name))
+        term_cache.delete(term_key('synonyms', term['language'], term['name']))
+        term_cache.delete(term_key('url', term['language'], term['name']))
@@ -1,12 +1,128 @@
 import json
+import re
+import unicodedata
 
-from . import ChatBot
+from . import ChatBot, send_msg_to_gpt
+from .single_flight import flights
+from ..cache import PersistentCache, hash_key
+from ..glovars import CACHE_DB_PATH, TRANSLATION_CACHE_MEMORY_SIZE, TRANSLATION_CACHE_DISK_SIZE, TRANSLATION_CACHE_TTL
 from ..utils import print_info
 
+# Bump when the translation prompt changes, so that old cached translations are no longer used
+TRANSLATION_PROMPT_VERSION = '1'
+
 translators: dict[str, ChatBot] = {}
 
+translation_cache = PersistentCache(
+    CACHE_DB_PATH,
+    'translation',
+    max_memory_items=TRANSLATION_CACHE_MEMORY_SIZE,
+    max_disk_items=TRANSLATION_CACHE_DISK_SIZE,
+    ttl=TRANSLATION_CACHE_TTL
+)
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def translation_key(lan_code: str, text: str) -> str:
+    return hash_key(TRANSLATION_PROMPT_VERSION, lan_code, normalize_text(text))
+
 
 def translate_to(lan_code: str, text: str):
+    cache_key = translation_key(lan_code, text)
+    cached = translation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    def translate_and_cache():
+        # The call that just finished may have cached it
+        translation = translation_cache.get(cache_key)
+        if translation is None:
+            translation = translate_by_gpt(lan_code, text)
+            if translation:
+                translation_cache.set(cache_key, translation)
+
+        return translation
+
+    # Concurrent identical translations share one GPT call
+    return flights.do(cache_key, translate_and_cache)
+
+
+def translate_to_many(lan_codes: list[str], text: str) -> dict[str, str]:
+    """
+    Translate the text into several languages, with a single GPT call for all the translations not cached yet.
+    A language missing from the batched response is translated on its own.
+    :return: {language code: translation}
+    """
+    translations = {}
+    missing = []
+    for lan_code in dict.fromkeys(lan_codes):
+        cached = translation_cache.get(translation_key(lan_code, text))
+        if cached is not None:
+            translations[lan_code] = cached
+        else:
+            missing.append(lan_code)
+
+    if len(missing) == 1:
+        translations[missing[0]] = translate_to(missing[0], text)
+    elif missing:
+        def translate_many_and_cache():
+            batch = translate_many_by_gpt(missing, text)
+            for lan_code, translation in batch.items():
+                translation_cache.set(translation_key(lan_code, text), translation)
+
+            return batch
+
+        # Concurrent identical fan-outs share one GPT call
+        batch = flights.do(('translate', tuple(missing), normalize_text(text)), translate_many_and_cache)
+        for lan_code in missing:
+            translations[lan_code] = batch.get(lan_code) or translate_to(lan_code, text)
+
+    return translations
+
+
+def translate_many_by_gpt(lan_codes: list[str], text: str) -> dict[str, str]:
+    prompt = """You are a translator API and you speak in JSON. Please recognize the input language and translate it
+into each of the languages specified by the language codes """ + ', '.join(lan_codes) + """.
+The format of your output content should be
+{"status": "OK", "translations": {"<language code>": "This is a translated sentence", ...}}
+with one entry for each of the language codes, and the language codes exactly as given.
+
+Please only output the JSON and no more, because your output will be passed directly to a JSON-to-Python-dict parser.
+
+Here is some context explanation that might help you translate better. The conversation happens on an online
+interrogation platform between doctors and patients. They speak different language and that is what you are helping
+with. Please translate accurately and professionally.
+
+There might be some unexpected input. When that happens, change the JSON attribute "status" to "error" and put the
+reason in "reason", like
+{"status": "error", "reason": "Not a sentence."}
+    """
+    translation = send_msg_to_gpt([
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": text}
+    ], 'translate', response_format={"type": "json_object"})
+    print_info(f'translations: {translation}')
+
+    try:
+        output = json.loads(translation)
+    except (TypeError, json.JSONDecodeError):
+        output = None
+
+    if not isinstance(output, dict) or output.get('status') != 'OK' or not isinstance(output.get('translations'), dict):
+        # error
+        print_info(output)
+        return {}
+
+    return {
+        lan_code: translation for lan_code, translation in output['translations'].items()
+        if lan_code in lan_codes and isinstance(translation, str) and translation
+    }
+
+
+def translate_by_gpt(lan_code: str, text: str):
     global translators
 
     prompt = """You are a translator API and you speak in JSON. Please recognize the input language and translate it
@@ -28,10 +144,10 @@ or
     """
     translator = translators.get(lan_code)
     if translator is None:
-        translator = ChatBot(lan_code, prompt)
+        translator = ChatBot(lan_code, prompt, purpose='translate')
         translators[lan_code] = translator
 
-    translation = translator.chat(text)
+    translation = translator.ask(text)
     print_info(f'translation: {translation}')
     output = json.loads(translation)
 
@@ -1,30 +1,69 @@
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 from flask_socketio import SocketIO
 
-import os
-
-from .glovars import HOST, PORT, DEBUG
+from .glovars import (
+    HOST, PORT, DEBUG, LOG_OUTPUT, SOCKETIO_ASYNC_MODE, WORKER_CONNECTIONS, SOCKETIO_PING_INTERVAL,
+    SOCKETIO_PING_TIMEOUT, SOCKETIO_MESSAGE_QUEUE
+)
 from . import database
+from . import invalidation
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 
+
+# One database connection per request, closed when the request is done.
+# Socket.IO handlers get theirs from database.connection_context
+@app.before_request
+def open_db_connection():
+    database.open_connection()
+
+
+@app.teardown_request
+def close_db_connection(exc):
+    # Flask-SocketIO runs this for its events too, which may be nested in another one still using the connection
+    if not hasattr(request, 'sid'):
+        database.close_connection()
+
+
 from . import error_handler
 from . import routes
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode=SOCKETIO_ASYNC_MODE,
+    message_queue=SOCKETIO_MESSAGE_QUEUE,
+    ping_interval=SOCKETIO_PING_INTERVAL,
+    ping_timeout=SOCKETIO_PING_TIMEOUT
+)
 
 from . import websocket
 
+# Drop from the caches what the other instances change
+invalidation.listen(database.connection_context)
+
 
 def app_run():
+    """
+    Development server in threading mode, or the eventlet/gevent server, which needs the standard library
+    monkey patched before anything else is imported (see run.py). In production, prefer gunicorn with wsgi.py.
+    """
+    # Bound the concurrent connections, websockets included
+    options = {}
+    if socketio.async_mode == 'eventlet':
+        options['max_size'] = WORKER_CONNECTIONS
+    elif socketio.async_mode == 'gevent':
+        options['spawn'] = WORKER_CONNECTIONS
+
     socketio.run(
         app,
         host=HOST,
         port=PORT,
         debug=DEBUG,
         use_reloader=DEBUG,
-        log_output=DEBUG,
-        allow_unsafe_werkzeug=True
+        log_output=LOG_OUTPUT,
+        allow_unsafe_werkzeug=DEBUG,
+        **options
     )
@@ -0,0 +1,84 @@
+# src/bot_state.py
+"""
+Per room state of the AI doctor, kept out of the ChatBot objects so that any instance can answer a room:
+{
+    'language': 'en',  # language of the bot's prompt
+    'messages': [{'role': 'user', 'content': '...'}, ...]  # history after the system prompt
+}
+
+BOT_STATE_URL selects the store: `local` (default) keeps it in this process, which only works with a single instance;
+`redis://host:6379/0` shares it between instances.
+
+Stores only hold the active rooms. A missing state is rebuilt from the stored messages (see load_bot_state), so
+nothing is lost on eviction or restart.
+"""
+import json
+
+from .cache import LRUCache
+from .glovars import BOT_STATE_URL, BOT_STATE_TTL, BOT_STATE_CACHE_SIZE, BOT_STATE_IDLE_TIMEOUT, AI_DOCTOR_MAX_HISTORY
+from . import database as db
+
+
+class LocalBotStateStore:
+    """
+    LRU of the most recently active rooms. A room idle for `idle_timeout` seconds is dropped.
+    """
+
+    def __init__(self, max_rooms: int, idle_timeout: int):
+        self._states = LRUCache(max_rooms, idle_timeout)
+
+    def get(self, room_id: int) -> dict | None:
+        return self._states.get(room_id)
+
+    def set(self, room_id: int, state: dict) -> None:
+        self._states.set(room_id, state)
+
+    def delete(self, room_id: int) -> None:
+        self._states.delete(room_id)
+
+
+class RedisBotStateStore:
+    KEY_PREFIX = 'heal:bot-state:'
+
+    def __init__(self, url: str, ttl: int):
+        import redis  # only needed with a redis:// BOT_STATE_URL
+
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, room_id: int) -> dict | None:
+        value = self.redis.get(self.KEY_PREFIX + str(room_id))
+        return None if value is None else json.loads(value)
+
+    def set(self, room_id: int, state: dict) -> None:
+        self.redis.set(self.KEY_PREFIX + str(room_id), json.dumps(state), ex=self.ttl)
+
+    def delete(self, room_id: int) -> None:
+        self.redis.delete(self.KEY_PREFIX + str(room_id))
+
+
+def make_bot_state_store(url: str):
+    if url == 'local':
+        return LocalBotStateStore(BOT_STATE_CACHE_SIZE, BOT_STATE_IDLE_TIMEOUT)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBotStateStore(url, BOT_STATE_TTL)
+
+    raise ValueError(f'Unsupported BOT_STATE_URL: {url}')
+
+
+bot_states = make_bot_state_store(BOT_STATE_URL)
+
+
+def load_bot_state(room_id: int, language: str, before_message_id: int) -> dict:
+    """
+    State of the room's AI doctor, rebuilt from the messages older than `before_message_id` if the store does not
+    have it. A new conversation takes `language`.
+    """
+    state = bot_states.get(room_id)
+    if state is None:
+        state = {
+            'language': language,
+            'messages': db.message_op.get_ai_doctor_history(room_id, before_message_id, AI_DOCTOR_MAX_HISTORY)
+        }
+
+    return state
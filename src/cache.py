@@ -0,0 +1,220 @@
+# src/cache.py
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_key(*parts: str) -> str:
+    """
+    Content address of a cache entry: sha256 over the key parts.
+    """
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache with an optional TTL (in seconds).
+
+    Example:
+    cache = LRUCache(max_size=1024, ttl=3600)
+    cache.set('key', 'value')
+    cache.get('key')  # 'value'
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._items[key]
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._items)
+            }
+
+    def __len__(self):
+        return len(self._items)
+
+
+class PersistentCache:
+    """
+    Two-tier cache: an LRUCache in front of a SQLite table. Values must be JSON serialisable.
+    Entries expire after `ttl` seconds (None for never), and the least recently used rows are dropped once the
+    table holds more than `max_disk_items`. An empty `path` keeps the cache in memory only.
+
+    Example:
+    cache = PersistentCache('cache.db', 'translation', ttl=30 * 24 * 3600)
+    cache.set(hash_key('ja', 'Hello'), 'こんにちは')
+    """
+
+    # prune the table once every PRUNE_INTERVAL writes instead of on every write
+    PRUNE_INTERVAL = 128
+
+    def __init__(self, path: str, namespace: str, max_memory_items: int = 1024, max_disk_items: int = 100000,
+                 ttl: float | None = None):
+        self.namespace = namespace
+        self.max_disk_items = max_disk_items
+        self.ttl = ttl
+        self.memory = LRUCache(max_memory_items, ttl)
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()  # the SQLite connection
+        self._stats_lock = threading.Lock()  # hits and misses
+        self._conn = None
+
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=wal')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entry ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                'PRIMARY KEY (namespace, key))'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_entry_accessed ON cache_entry (namespace, accessed_at)'
+            )
+
+    def get(self, key: str, default=None):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count(hit=True)
+            return value
+
+        entry = self._disk_get(key)
+        if entry is None:
+            self._count(hit=False)
+            return default
+
+        # In memory until the entry expires, not for a whole TTL from now
+        value, created_at = entry
+        self.memory.set(key, value, None if self.ttl is None else self.ttl - (time.time() - created_at))
+        self._count(hit=True)
+        return value
+
+    def set(self, key: str, value) -> None:
+        self.memory.set(key, value)
+        if self._conn is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache_entry (namespace, key, value, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, key, json.dumps(value), now, now)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL == 0:
+                self._prune(now)
+
+    def delete(self, key: str) -> None:
+        self.memory.delete(key)
+        if self._conn is None:
+            return
+
+        with self._lock:
+            self._conn.execute('DELETE FROM cache_entry WHERE namespace = ? AND key = ?', (self.namespace, key))
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'memory': self.memory.stats()
+        }
+
+    def _count(self, hit: bool) -> None:
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _disk_get(self, key: str) -> tuple | None:
+        """
+        (value, creation time) of an entry, or None if there is none or it expired.
+        """
+        if self._conn is None:
+            return None
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created_at FROM cache_entry WHERE namespace = ? AND key = ?',
+                (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, created_at = row
+            if self.ttl is not None and created_at + self.ttl < now:
+                self._conn.execute('DELETE FROM cache_entry WHERE namespace = ? AND key = ?', (self.namespace, key))
+                return None
+
+            self._conn.execute(
+                'UPDATE cache_entry SET accessed_at = ? WHERE namespace = ? AND key = ?',
+                (now, self.namespace, key)
+            )
+
+        return json.loads(value), created_at
+
+    def _prune(self, now: float) -> None:
+        # Caller holds self._lock
+        if self.ttl is not None:
+            self._conn.execute(
+                'DELETE FROM cache_entry WHERE namespace = ? AND created_at < ?',
+                (self.namespace, now - self.ttl)
+            )
+
+        self._conn.execute(
+            'DELETE FROM cache_entry WHERE namespace = ? AND key IN ('
+            'SELECT key FROM cache_entry WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.max_disk_items)
+        )
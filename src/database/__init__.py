@@ -1,6 +1,4 @@
-import os
-
-from ..glovars import DB_PATH
+from ..glovars import TERM_CACHE_WARM_UP
 from ..utils import print_info
 from . import data_models
 
@@ -9,19 +7,45 @@ from . import chat_op as chat
 from . import condition_op
 from . import room_op
 from . import message_op
+from . import term_matcher
+from . import migrations
+
+# Opens a connection for a block or a function, and closes it afterwards. Reentrant.
+connection_context = data_models.connection_context
+# Gives the connection back during a block that does not need it, like a GPT call
+released_connection = data_models.released_connection
+# Runs a block or a function in a transaction (a savepoint when nested).
+atomic = data_models.db.atomic
+
+
+def open_connection():
+    data_models.db.connect(reuse_if_open=True)
+
 
+def close_connection():
+    if not data_models.db.is_closed():
+        data_models.db.close()
 
-def init_sqlite():
+
+def init_database():
     data_models.init()
-    return
+    migrations.mark_all_applied()
+
 
 def __init():
-    if not os.path.isfile(DB_PATH):
-        print_info(f'{DB_PATH} not found. Initializing...')
-        init_sqlite()
+    with data_models.connection_context():
+        initialized = data_models.db.table_exists(data_models.BaseUser._meta.table_name)
+
+    if not initialized:
+        print_info(f'Database {data_models.db.database} is empty. Initializing...')
+        init_database()
     else:
-        print_info(f'Found {DB_PATH}.')
+        print_info(f'Found database {data_models.db.database}.')
+        migrations.run()
+
+    if TERM_CACHE_WARM_UP:
+        with data_models.connection_context():
+            print_info(f'Term cache warmed up: {message_op.cache_terms(overwrite=False)} entries written.')
 
-    return
 
-__init()
\ No newline at end of file
+__init()
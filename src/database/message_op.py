@@ -1,13 +1,16 @@
 # src/database/message_op.py
+import base64
 from typing import List
 
-from peewee import DoesNotExist
+from peewee import DoesNotExist, JOIN
 from datetime import datetime
 
-from ..GPT import highlighter, translate_to
+from .. import invalidation
+from ..GPT import highlighter, translate_to, term_cache, find_term_url
 
-from .data_models import MedicalTerm, MedicalTermInfo, Message, \
-    MessageTermCache, MedicalTermSynonym, MessageTranslationCache, BaseUser
+from .data_models import db, released_connection, MedicalTerm, MedicalTermInfo, Message, \
+    MessageTermCache, MedicalTermSynonym, MessageTranslationCache, BaseUser, Room
+from .term_matcher import matcher
 
 from ..utils import print_info
 
@@ -30,12 +33,61 @@ def get_chat_messages(room_id: int, page_num: int, limit_num: int, language_code
                      .order_by(Message.id)
                      .limit(limit_num)
                      .offset(offset))
-    room_message_list = []
 
-    for room_message in room_messages:
-        room_message_list.append(get_message(room_id, room_message.id, language_code))
+    return build_messages(list(room_messages), language_code)
 
-    return room_message_list
+
+def get_chat_messages_by_cursor(room_id: int, limit_num: int, language_code: str,
+                                before: str | None = None, after: str | None = None) -> dict:
+    """
+    Get messages from a chat room with keyset pagination, so that every page costs the same whatever its depth.
+
+    Parameters:
+    room_id (int): ID of the room
+    limit_num (int): Number of messages per page
+    language_code (str): Language code for translations
+    before (str): Cursor. Get the messages older than it. An empty cursor starts from the latest message
+    after (str): Cursor. Get the messages newer than it. Ignored if `before` is given
+
+    Returns:
+    dict: Messages in ascending order, and the cursor of the next page in the same direction (None if no more)
+    {
+        "messages": [...],
+        "nextCursor": "MTI"
+    }
+    """
+    query = Message.select().where(Message.room == room_id)
+
+    if before is not None:
+        if before:
+            query = query.where(Message.id < decode_cursor(before))
+        room_messages = list(query.order_by(Message.id.desc()).limit(limit_num))[::-1]
+        next_message = room_messages[0] if room_messages else None
+    else:
+        if after:
+            query = query.where(Message.id > decode_cursor(after))
+        room_messages = list(query.order_by(Message.id).limit(limit_num))
+        next_message = room_messages[-1] if room_messages else None
+
+    return {
+        "messages": build_messages(room_messages, language_code),
+        "nextCursor": (encode_cursor(next_message.id)
+                       if next_message is not None and len(room_messages) == limit_num else None)
+    }
+
+
+def encode_cursor(message_id: int) -> str:
+    return base64.urlsafe_b64encode(str(message_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Raises ValueError if the cursor is invalid
+    """
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
 
 
 def get_message(room_id: int, message_id: int, language_code: str) -> dict:
@@ -53,39 +105,117 @@ def get_message(room_id: int, message_id: int, language_code: str) -> dict:
     message = Message.get((Message.room == room_id) & (Message.id == message_id))
     print_info(f"Retrieving message: {str({ 'id': message_id, 'text': message.text })}")
 
-    try:
-        translation = MessageTranslationCache.get(
-            (MessageTranslationCache.message == message_id) &
+    return build_messages([message], language_code)[0]
+
+
+def build_messages(messages: List[Message], language_code: str) -> list[dict]:
+    """
+    Assemble messages with their translation and medical terms, with a fixed number of queries whatever the number of
+    messages: translations, term links joined with their synonyms, then the terms.
+
+    Parameters:
+    messages (list): Message rows
+    language_code (str): Language code for translations
+
+    Returns:
+    list: Messages in the format of get_message, in the same order
+    """
+    message_ids = [message.id for message in messages]
+    if not message_ids:
+        return []
+
+    translations = {
+        translation.message_id: translation.translated_text
+        for translation in MessageTranslationCache.select().where(
+            (MessageTranslationCache.message.in_(message_ids)) &
             (MessageTranslationCache.language_code == language_code)
         )
-        translated_text = translation.translated_text
-    except DoesNotExist:
-        translated_text = message.text
+    }
 
-    message_terms = MessageTermCache.select().where(MessageTermCache.message == message_id)
-    medical_terms = [
+    OriginalSynonym = MedicalTermSynonym.alias()
+    TranslatedSynonym = MedicalTermSynonym.alias()
+    message_terms = (MessageTermCache
+                     .select(MessageTermCache, OriginalSynonym, TranslatedSynonym)
+                     .join(OriginalSynonym, JOIN.LEFT_OUTER,
+                           on=(MessageTermCache.original_synonym == OriginalSynonym.id), attr='original_synonym')
+                     .switch(MessageTermCache)
+                     .join(TranslatedSynonym, JOIN.LEFT_OUTER,
+                           on=(MessageTermCache.translated_synonym == TranslatedSynonym.id), attr='translated_synonym')
+                     .where(MessageTermCache.message.in_(message_ids)))
+
+    terms_by_message = {message_id: [] for message_id in message_ids}
+    for message_term in message_terms:
+        terms_by_message[message_term.message_id].append(message_term)
+
+    term_infos = get_terms(list({message_term.medical_term_id
+                                 for message_terms in terms_by_message.values()
+                                 for message_term in message_terms}), language_code)
+
+    texts = {message.id: translations.get(message.id, message.text) for message in messages}
+    synonyms = shown_synonyms(terms_by_message, texts, language_code)
+
+    return [
         {
-            'synonym': (message_term.translated_synonym.synonym if message_term.translated_synonym
-                        else message_term.original_synonym.synonym),
-            'termInfo': get_term(message_term.medical_term.id, language_code)
-        } for message_term in message_terms
+            "messageId": message.id,
+            "roomId": message.room_id,
+            "senderUserId": message.user_id,
+            "timestamp": message.send_time.isoformat(),
+            "content": {
+                "text": message.text,
+                "metadata": {
+                    "translation": translations.get(message.id, message.text),
+                    "medicalTerms": [
+                        {
+                            'synonym': synonyms[(message.id, message_term.medical_term_id)],
+                            'termInfo': term_infos[message_term.medical_term_id]
+                        } for message_term in terms_by_message[message.id]
+                    ]
+                }
+            }
+        } for message in messages
     ]
 
-    print(medical_terms)
 
-    return {
-        "messageId": message.id,
-        "roomId": message.room.id,
-        "senderUserId": message.user.id,
-        "timestamp": message.send_time.isoformat(),
-        "content": {
-            "text": message.text,
-            "metadata": {
-                "translation": translated_text,
-                "medicalTerms": medical_terms
-            }
-        }
-    }
+def shown_synonyms(terms_by_message: dict, texts: dict, language_code: str) -> dict:
+    """
+    The synonym of each term link as it appears in the text shown. The synonym stored with the link is the one found
+    in the text that was analyzed; when the message is shown in another language, a synonym of the term in that
+    language that appears in the text is used instead, if any. One query at most.
+
+    Parameters:
+    terms_by_message (dict): Message ID -> MessageTermCache rows, joined with their synonyms
+    texts (dict): Message ID -> text shown
+    language_code (str): Language of the texts
+
+    Returns:
+    dict: (message ID, medical term ID) -> synonym
+    """
+    synonyms = {}
+    missing = []
+    for message_id, message_terms in terms_by_message.items():
+        for message_term in message_terms:
+            synonym = (message_term.translated_synonym.synonym if message_term.translated_synonym
+                       else message_term.original_synonym.synonym)
+            synonyms[(message_id, message_term.medical_term_id)] = synonym
+            if synonym.casefold() not in texts[message_id].casefold():
+                missing.append((message_id, message_term.medical_term_id))
+
+    if not missing:
+        return synonyms
+
+    candidates = {}
+    for synonym in (MedicalTermSynonym.select()
+                    .where((MedicalTermSynonym.medical_term.in_(list({term_id for _, term_id in missing}))) &
+                           (MedicalTermSynonym.language_code == language_code))):
+        candidates.setdefault(synonym.medical_term_id, []).append(synonym.synonym)
+
+    for message_id, term_id in missing:
+        text = texts[message_id].casefold()
+        found = [synonym for synonym in candidates.get(term_id, []) if synonym.casefold() in text]
+        if found:
+            synonyms[(message_id, term_id)] = max(found, key=len)
+
+    return synonyms
 
 
 def create_term(term_type, term_info_list):
@@ -138,28 +268,73 @@ def create_term(term_type, term_info_list):
     if not term_info_list:
         raise ValueError("termInfoList cannot be empty")
 
-    new_term = MedicalTerm.create(term_type=term_type)
-    new_term.save()
-
-    for term_info in term_info_list:
-        MedicalTermInfo.create(
-            medical_term=new_term.id,
-            language_code=term_info.get('languageCode', 'en'),
-            name=term_info.get('name'),
-            description=term_info.get('description'),
-            url=term_info.get('url')
-        )
+    # All or nothing: a synonym of another term raises IntegrityError
+    with db.atomic():
+        new_term = MedicalTerm.create(term_type=term_type)
+        new_term.save()
 
-        for synonym in term_info.get('synonyms', []):
-            MedicalTermSynonym.create(
+        for term_info in term_info_list:
+            MedicalTermInfo.create(
                 medical_term=new_term.id,
-                synonym=synonym.get('synonym'),
-                language_code=synonym.get('languageCode', term_info.get('languageCode', 'en'))
+                language_code=term_info.get('languageCode', 'en'),
+                name=term_info.get('name'),
+                description=term_info.get('description'),
+                url=term_info.get('url')
             )
 
+            for synonym in term_info.get('synonyms', []):
+                MedicalTermSynonym.create(
+                    medical_term=new_term.id,
+                    synonym=synonym.get('synonym'),
+                    language_code=synonym.get('languageCode', term_info.get('languageCode', 'en'))
+                )
+
+    refresh_terms([new_term.id])
     return new_term.id
 
 
+def create_analyzed_term(language_code: str, name: str, synonyms: list[str], explanation: dict) -> tuple[int, bool]:
+    """
+    Create a medical term found by GPT, unless another request has just created it: synonyms are unique per
+    language, so the request whose synonym insert wins creates the term, and the others use it.
+
+    Parameters:
+    language_code (str): Language of the term
+    name (str): The term as found in the text
+    synonyms (list): Its synonyms
+    explanation (dict): {"type": "CONDITION", "description": "...", "url": "https://..." or None}
+
+    Returns:
+    tuple: (ID of the medical term, whether it was created). Call refresh_terms once it is committed
+    """
+    with db.atomic() as transaction:
+        term = MedicalTerm.create(term_type=explanation['type'])
+        (MedicalTermSynonym
+         .insert_many([
+            {'medical_term': term.id, 'synonym': synonym, 'language_code': language_code}
+            for synonym in dict.fromkeys([name, *synonyms])
+         ])
+         .on_conflict_ignore()
+         .execute())
+
+        owner_id = (MedicalTermSynonym
+                    .get((MedicalTermSynonym.synonym == name) & (MedicalTermSynonym.language_code == language_code))
+                    .medical_term_id)
+        if owner_id != term.id:
+            transaction.rollback()
+            return owner_id, False
+
+        MedicalTermInfo.create(
+            medical_term=term.id,
+            language_code=language_code,
+            name=name,
+            description=explanation['description'],
+            url=explanation['url']
+        )
+
+    return term.id, True
+
+
 def get_term(term_id, language_code):
     """
     Get information about a medical term.
@@ -182,14 +357,44 @@ def get_term(term_id, language_code):
         )
     except Exception as e:
         print(e)
+        medical_term_info = None
+
+    return term_dict(medical_term, medical_term_info)
+
+
+def get_terms(term_ids: list[int], language_code: str) -> dict[int, dict]:
+    """
+    Get information about several medical terms in two queries.
+
+    Parameters:
+    term_ids (list): IDs of the medical terms
+    language_code (str): Language code for the response
+
+    Returns:
+    dict: Information about each medical term, in the format of get_term, by term ID
+    """
+    if not term_ids:
+        return {}
+
+    term_info_by_id = {}
+    for medical_term_info in MedicalTermInfo.select().where(MedicalTermInfo.medical_term.in_(term_ids)):
+        # Like get_term, use the first info stored for the term
+        term_info_by_id.setdefault(medical_term_info.medical_term_id, medical_term_info)
 
     return {
-        "medicalTermId": term_id,
+        medical_term.id: term_dict(medical_term, term_info_by_id.get(medical_term.id))
+        for medical_term in MedicalTerm.select().where(MedicalTerm.id.in_(term_ids))
+    }
+
+
+def term_dict(medical_term: MedicalTerm, medical_term_info: MedicalTermInfo | None) -> dict:
+    return {
+        "medicalTermId": medical_term.id,
         "medicalTermType": medical_term.term_type,
-        "name": medical_term_info.name,
-        "description": medical_term_info.description,
+        "name": medical_term_info.name if medical_term_info else None,
+        "description": medical_term_info.description if medical_term_info else None,
         "medicalTermLinks": [
-            medical_term_info.url
+            medical_term_info.url if medical_term_info else None
         ]
     }
 
@@ -285,6 +490,15 @@ def update_term(term_id: int, term_update_info: dict, language_code: str):
     Returns:
     dict: Updated information about the medical term
     """
+    old_terms = known_terms([term_id])  # their old names and synonyms are no longer cached
+    with db.atomic():
+        update_term_rows(term_id, term_update_info, language_code)
+
+    refresh_terms([term_id], old_terms)
+    return get_term(term_id, language_code)
+
+
+def update_term_rows(term_id: int, term_update_info: dict, language_code: str):
     term = MedicalTerm.get(MedicalTerm.id == term_id)
 
     if 'termType' in term_update_info:
@@ -326,7 +540,6 @@ def update_term(term_id: int, term_update_info: dict, language_code: str):
             )
 
     term.save()
-    return get_term(term_id, language_code)
 
 
 def delete_term(term_id: int):
@@ -337,7 +550,102 @@ def delete_term(term_id: int):
     term_id (int): ID of the medical term
     """
     term = MedicalTerm.get(MedicalTerm.id == term_id)
+    old_terms = known_terms([term_id])
     term.delete_instance()
+    refresh_terms([term_id], old_terms)
+
+
+def known_terms(term_ids: list[int] | None = None) -> list[dict]:
+    """
+    Stored terms in every language they are described in, in the format of GPT.term_cache.store_terms.
+
+    Parameters:
+    term_ids (list): IDs of the medical terms, None for all
+
+    Returns:
+    list: [{"language": "en", "name": "fever", "type": "CONDITION", "description": "...", "url": "...",
+            "synonyms": ["fever", "pyrexia"]}]
+    """
+    infos = MedicalTermInfo.select(MedicalTermInfo, MedicalTerm).join(MedicalTerm)
+    synonyms = MedicalTermSynonym.select()
+    if term_ids is not None:
+        infos = infos.where(MedicalTermInfo.medical_term.in_(term_ids))
+        synonyms = synonyms.where(MedicalTermSynonym.medical_term.in_(term_ids))
+
+    synonyms_by_term = {}
+    for synonym in synonyms:
+        synonyms_by_term.setdefault((synonym.medical_term_id, synonym.language_code), []).append(synonym.synonym)
+
+    return [
+        {
+            "language": info.language_code,
+            "name": info.name,
+            "type": info.medical_term.term_type,
+            "description": info.description,
+            "url": info.url,
+            "synonyms": synonyms_by_term.get((info.medical_term_id, info.language_code), [])
+        } for info in infos
+    ]
+
+
+def cache_terms(term_ids: list[int] | None = None, overwrite: bool = True) -> int:
+    """
+    Put stored terms in the term enrichment cache, so that GPT is not asked about them again.
+
+    Parameters:
+    term_ids (list): IDs of the medical terms, None for all
+    overwrite (bool): False to keep what is already cached
+
+    Returns:
+    int: Number of cache entries written
+    """
+    return term_cache.store_terms(known_terms(term_ids), overwrite)
+
+
+def _refresh_terms(term_ids: list[int], old_terms: list[dict]) -> None:
+    term_cache.forget_terms(old_terms)
+    for term_id in term_ids:
+        matcher.sync_term(term_id)
+    cache_terms(term_ids)
+
+
+invalidation.register('terms', _refresh_terms)
+
+
+def refresh_terms(term_ids: list[int], old_terms: list[dict] | None = None) -> None:
+    """
+    Bring the term matcher and the term cache of every instance up to date with stored terms, once they are
+    committed.
+
+    Parameters:
+    term_ids (list): IDs of the medical terms created, changed or deleted
+    old_terms (list): The terms as they were before, from known_terms, to drop what is no longer true from the cache
+    """
+    invalidation.publish('terms', term_ids, old_terms or [])
+
+
+def fill_term_url(term_id: int, language_code: str, name: str, candidate_url: str | None = None) -> str:
+    """
+    Check the candidate URL of a term, or find another one, and store it. Meant to run out of the message pipeline,
+    as it may wait for external sites and GPT.
+
+    Parameters:
+    term_id (int): ID of the medical term
+    language_code (str): Language of the term information to update
+    name (str): Name of the term in that language
+    candidate_url (str): URL to check first
+
+    Returns:
+    str: The stored URL, "None" if none was found
+    """
+    with released_connection():
+        url = find_term_url(language_code, name, candidate_url)
+    (MedicalTermInfo
+     .update(url=url)
+     .where((MedicalTermInfo.medical_term == term_id) & (MedicalTermInfo.language_code == language_code))
+     .execute())
+    refresh_terms([term_id])
+    return url
 
 
 def create_link(message_id, term_id, original_synonym_id=None, translated_synonym_id=None):
@@ -681,3 +989,34 @@ def save_message_only(user_id: int, room_id: int, text: str, date_time: datetime
     )
 
     return message.id
+
+
+def get_ai_doctor_history(room_id: int, before_id: int, limit_num: int) -> list[dict]:
+    """
+    Rebuild the AI doctor's conversation of a room from the stored messages: the bot's (user 0) and the patient's.
+
+    Parameters:
+    room_id (int): ID of the room
+    before_id (int): Only the messages older than this message
+    limit_num (int): Number of latest messages to keep
+
+    Returns:
+    list: ChatBot history, oldest first
+    [
+        {"role": "user", "content": "I have a fever"},
+        {"role": "assistant", "content": "How long have you had it?"}
+    ]
+    """
+    messages = (Message
+                .select(Message.user, Message.text)
+                .join(Room)
+                .where((Message.room == room_id) &
+                       (Message.id < before_id) &
+                       ((Message.user == 0) | (Message.user == Room.patient)))
+                .order_by(Message.id.desc())
+                .limit(limit_num))
+
+    return [
+        {"role": "assistant" if message.user_id == 0 else "user", "content": message.text}
+        for message in reversed(list(messages))
+    ]
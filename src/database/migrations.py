@@ -0,0 +1,172 @@
+# src/database/migrations.py
+"""
+Versioned schema migrations for existing databases.
+
+data_models.init() creates a new database with the current schema, so it is marked as having every migration applied.
+An existing database gets the migrations it has not seen yet, in order, at startup. To change the schema, change the
+models and append a migration that does the same to an existing database.
+"""
+from datetime import datetime
+
+from peewee import Model, IntegerField, TextField, DateTimeField
+from playhouse.migrate import SchemaMigrator, make_index_name, migrate
+
+from .data_models import (
+    db, connection_context, Message, DoctorInRoom, SecondOpinionRequest, MedicalTermInfo, PatientCondition, PatientPrescription,
+    MedicalTermSynonym, MessageTermCache
+)
+from ..utils import print_info
+
+
+class SchemaMigration(Model):
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    applied_time = DateTimeField()
+
+    class Meta:
+        database = db
+        table_name = 'schema_migration'
+
+
+def add_indexes(*indexes: tuple[type[Model], tuple[str, ...]], unique: bool = False) -> None:
+    """
+    Add indexes, named like the ones of the models' Meta.indexes, unless they already exist.
+
+    Parameters:
+    indexes: (model, field names) pairs, like (Message, ('room', 'id'))
+    unique (bool): Whether the indexes are unique
+    """
+    migrator = SchemaMigrator.from_database(db)
+    operations = []
+    for model, field_names in indexes:
+        table = model._meta.table_name
+        columns = [model._meta.fields[name].column_name for name in field_names]
+        existing = {index.name for index in db.get_indexes(table)}
+        if make_index_name(table, columns) not in existing:
+            operations.append(migrator.add_index(table, columns, unique))
+
+    migrate(*operations)
+
+
+def add_message_room_index():
+    add_indexes((Message, ('room', 'id')))
+
+
+def add_hot_path_indexes():
+    add_indexes(
+        (DoctorInRoom, ('room', 'enabled')),
+        (DoctorInRoom, ('doctor', 'enabled')),
+        (SecondOpinionRequest, ('second_opinion_doctor', 'room')),
+        (MedicalTermInfo, ('approved', 'language_code')),
+        (PatientCondition, ('patient', 'medical_term')),
+        (PatientPrescription, ('user_condition', 'medical_term'))
+    )
+
+
+def unique_synonyms():
+    """
+    Keep the oldest of the synonyms with the same text and language, moving the message links of the others to it,
+    then make them unique.
+    A duplicate of another term's synonym has its message links moved to that term too, as the terms are not merged:
+    a message already linked to that term keeps its link, and drops the duplicate's.
+    """
+    kept = {}
+    duplicates = {}
+    term_ids = {}
+    for synonym in MedicalTermSynonym.select().order_by(MedicalTermSynonym.id):
+        term_ids[synonym.id] = synonym.medical_term_id
+        key = (synonym.language_code, synonym.synonym)
+        if key in kept:
+            duplicates[synonym.id] = kept[key]
+        else:
+            kept[key] = synonym.id
+
+    # synonym id -> id of the term it belongs to once the duplicates are gone
+    owners = {synonym_id: term_ids[duplicates.get(synonym_id, synonym_id)] for synonym_id in term_ids}
+    for duplicate_id, kept_id in duplicates.items():
+        if term_ids[duplicate_id] != term_ids[kept_id]:
+            move_links(duplicate_id, term_ids[duplicate_id], term_ids[kept_id], owners)
+
+        (MessageTermCache.update(original_synonym=kept_id)
+         .where(MessageTermCache.original_synonym == duplicate_id).execute())
+        (MessageTermCache.update(translated_synonym=kept_id)
+         .where(MessageTermCache.translated_synonym == duplicate_id).execute())
+
+    if duplicates:
+        MedicalTermSynonym.delete().where(MedicalTermSynonym.id.in_(list(duplicates))).execute()
+        print_info(f'Removed {len(duplicates)} duplicate synonyms.')
+
+    add_indexes((MedicalTermSynonym, ('language_code', 'synonym')), unique=True)
+
+
+def move_links(synonym_id: int, from_term_id: int, to_term_id: int, owners: dict[int, int]) -> None:
+    """
+    Link the messages linked to a term by one of its synonyms to another term instead.
+
+    Parameters:
+    synonym_id (int): ID of the synonym
+    from_term_id (int): ID of its term
+    to_term_id (int): ID of the term to link the messages to
+    owners (dict): synonym ID -> ID of the term it ends up with, of all the synonyms
+    """
+    links = (MessageTermCache.select()
+             .where((MessageTermCache.medical_term == from_term_id) &
+                    ((MessageTermCache.original_synonym == synonym_id) |
+                     (MessageTermCache.translated_synonym == synonym_id))))
+    for link in list(links):
+        # (medical_term, message) is the primary key, so each row is addressed by both
+        row = (MessageTermCache.medical_term == from_term_id) & (MessageTermCache.message == link.message_id)
+        linked = (MessageTermCache.select()
+                  .where((MessageTermCache.medical_term == to_term_id) &
+                         (MessageTermCache.message == link.message_id))
+                  .exists())
+        if linked:
+            MessageTermCache.delete().where(row).execute()
+            continue
+
+        # The synonym of the other side, if any, may stay with the old term: then unlink it
+        changes = {MessageTermCache.medical_term: to_term_id}
+        if link.original_synonym_id is not None and owners[link.original_synonym_id] != to_term_id:
+            changes[MessageTermCache.original_synonym] = None
+        if link.translated_synonym_id is not None and owners[link.translated_synonym_id] != to_term_id:
+            changes[MessageTermCache.translated_synonym] = None
+        MessageTermCache.update(changes).where(row).execute()
+
+
+# (version, name, migration). Append only: never renumber or edit an applied migration
+MIGRATIONS = [
+    (1, 'message_room_index', add_message_room_index),
+    (2, 'hot_path_indexes', add_hot_path_indexes),
+    (3, 'unique_synonyms', unique_synonyms),
+]
+
+
+def mark_all_applied() -> None:
+    """
+    Record every migration as applied, for a database just created from the models.
+    """
+    with connection_context():
+        db.create_tables([SchemaMigration])
+        now = datetime.now()
+        (SchemaMigration
+         .insert_many([(version, name, now) for version, name, _ in MIGRATIONS],
+                      fields=[SchemaMigration.version, SchemaMigration.name, SchemaMigration.applied_time])
+         .on_conflict_ignore()
+         .execute())
+
+
+def run() -> None:
+    """
+    Apply the migrations the database has not seen yet, each in its own transaction.
+    """
+    with connection_context():
+        db.create_tables([SchemaMigration])
+        applied = {migration.version for migration in SchemaMigration.select(SchemaMigration.version)}
+        for version, name, migration in MIGRATIONS:
+            if version in applied:
+                continue
+
+            with db.atomic():
+                migration()
+                SchemaMigration.create(version=version, name=name, applied_time=datetime.now())
+            print_info(f'Applied migration {version}: {name}.')
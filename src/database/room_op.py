@@ -3,7 +3,15 @@ from peewee import DoesNotExist, JOIN, fn
 from datetime import datetime
 
 from .data_models import Room, DoctorInRoom, SecondOpinionRequest, BaseUser
-from .user_op import get_user_full
+from .user_op import get_users_full
+from .. import invalidation
+from ..cache import LRUCache
+from ..glovars import MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_SIZE
+
+# (user id, room id) -> bool
+membership_cache = LRUCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+invalidation.register('membership', lambda user_id, room_id: membership_cache.delete((user_id, room_id)))
+invalidation.register('memberships', membership_cache.clear)
 
 
 def check_room(room_id):
@@ -23,6 +31,28 @@ def check_room(room_id):
         return False
 
 
+def is_member(user_id: int, room_id: int) -> bool:
+    """
+    Check if a user is the patient of a room, or a doctor who joined it. Each check is an index lookup, and the
+    result is cached for MEMBERSHIP_CACHE_TTL seconds.
+
+    Parameters:
+    user_id (int): ID of the user
+    room_id (int): ID of the room
+
+    Returns:
+    bool: True if the user is in the room
+    """
+    member = membership_cache.get((user_id, room_id))
+    if member is not None:
+        return member
+
+    member = (Room.select().where((Room.id == room_id) & (Room.patient == user_id)).exists() or
+              DoctorInRoom.select().where((DoctorInRoom.doctor == user_id) & (DoctorInRoom.room == room_id)).exists())
+    membership_cache.set((user_id, room_id), member)
+    return member
+
+
 def create_room(user_id):
     """
     Create a new room.
@@ -38,6 +68,7 @@ def create_room(user_id):
         creation_time=datetime.now()
     )
     new_room.save()
+    invalidation.publish('membership', user_id, new_room.id)
     return new_room.id
 
 
@@ -51,24 +82,48 @@ def get_room(room_id):
     Returns:
     dict: Details of the room including participants
     """
-    room = Room.get(Room.id == room_id)
-    participant_list = []
+    rooms = get_rooms([room_id])
+    if not rooms:
+        raise Room.DoesNotExist(f'Room {room_id} does not exist')
+
+    return rooms[0]
 
-    patient = get_user_full(room.patient.base_user_id)
-    participant_list.append(patient)
 
-    doctors_in_room = DoctorInRoom.select().where(DoctorInRoom.room == room.id)
+def get_rooms(room_ids: list[int]) -> list[dict]:
+    """
+    Get details of several rooms with a fixed number of queries: rooms, doctors in the rooms, then the participants.
 
-    for doctor_in_room in doctors_in_room:
-        doctor = get_user_full(doctor_in_room.doctor.base_user_id)
-        participant_list.append(doctor)
+    Parameters:
+    room_ids (list): IDs of the rooms
 
-    return {
-        "roomId": room.id,
-        "roomName": "",
-        "creationTime": room.creation_time,
-        "participants": participant_list
-    }
+    Returns:
+    list: Details of each room in the format of get_room, in the order of room_ids. Missing rooms are left out
+    """
+    if not room_ids:
+        return []
+
+    rooms = {room.id: room for room in Room.select().where(Room.id.in_(room_ids))}
+
+    doctor_ids_by_room = {room_id: [] for room_id in rooms}
+    for doctor_in_room in DoctorInRoom.select().where(DoctorInRoom.room.in_(list(rooms))):
+        doctor_ids_by_room[doctor_in_room.room_id].append(doctor_in_room.doctor_id)
+
+    # The primary key of Patient and Doctor is the id of their BaseUser
+    participant_ids = {room.patient_id for room in rooms.values()}
+    for doctor_ids in doctor_ids_by_room.values():
+        participant_ids.update(doctor_ids)
+    participants = get_users_full(list(participant_ids))
+
+    return [
+        {
+            "roomId": rooms[room_id].id,
+            "roomName": "",
+            "creationTime": rooms[room_id].creation_time,
+            "participants": [participants[rooms[room_id].patient_id]] + [
+                participants[doctor_id] for doctor_id in doctor_ids_by_room[room_id]
+            ]
+        } for room_id in room_ids if room_id in rooms
+    ]
 
 
 def participant_room(user_id, room_id):
@@ -93,6 +148,7 @@ def participant_room(user_id, room_id):
         enabled=True
     )
     new_doctor_in_room.save()
+    invalidation.publish('membership', user_id, room_id)
     return True
 
 
@@ -110,6 +166,7 @@ def leave_room(user_id, room_id):
     try:
         doctor_in_room = DoctorInRoom.get((DoctorInRoom.doctor == user_id) & (DoctorInRoom.room == room_id))
         doctor_in_room.delete_instance()
+        invalidation.publish('membership', user_id, room_id)
         return True
     except DoesNotExist:
         return False
@@ -130,15 +187,13 @@ def get_rooms_all_fixed(user_id) -> dict:
     room_list = []
 
     if user.user_type == 1:  # Patient
-        rooms = Room.select().where(Room.patient == user_id)
+        rooms = Room.select(Room.id).where(Room.patient == user_id)
     elif user.user_type == 2:  # Doctor
-        rooms = Room.select().join(DoctorInRoom).where(DoctorInRoom.doctor == user_id)
+        rooms = Room.select(Room.id).join(DoctorInRoom).where(DoctorInRoom.doctor == user_id)
     else:
         return {"rooms": room_list}
 
-    for room in rooms:
-        room_data = get_room(room.id)
-        room_list.append(room_data)
+    room_list = get_rooms([room.id for room in rooms])
 
     return {"rooms": room_list}
 
@@ -152,12 +207,8 @@ def get_rooms_all(user_id) -> dict:
     Returns:
     dict: List of rooms
     """
-    rooms = Room.select().where(Room.patient == user_id)
-    room_list = []
-
-    for room in rooms:
-        room_data = get_room(room.id)
-        room_list.append(room_data)
+    rooms = Room.select(Room.id).where(Room.patient == user_id)
+    room_list = get_rooms([room.id for room in rooms])
 
     return {"rooms": room_list}
 
@@ -192,6 +243,8 @@ def delete_room(room_id: int):
     """
     room = Room.get(Room.id == room_id)
     room.delete_instance()
+    # Entries are keyed by user, so drop them all. Rooms are rarely deleted
+    invalidation.publish('memberships')
 
 
 def get_room_doctor_ids(roomId: int) -> list[int]:
@@ -202,6 +255,19 @@ def get_room_doctor_ids(roomId: int) -> list[int]:
     doctors = DoctorInRoom.select().where(DoctorInRoom.room == roomId)
     return [doctor.doctor_id for doctor in doctors]
 
+
+def get_room_languages(roomId: int) -> list[str]:
+    """
+    :return: The distinct languages of the patient and the doctors of a room
+    """
+
+    patient_ids = Room.select(Room.patient).where(Room.id == roomId)
+    doctor_ids = DoctorInRoom.select(DoctorInRoom.doctor).where(DoctorInRoom.room == roomId)
+    users = (BaseUser.select(BaseUser.language_code)
+             .where(BaseUser.id.in_(patient_ids) | BaseUser.id.in_(doctor_ids))
+             .distinct())
+    return [user.language_code for user in users]
+
 def get_step1_rooms():
     """
     Get all rooms that only have a patient and no doctors.
@@ -216,16 +282,11 @@ def get_step1_rooms():
 
     # Main query to select rooms that are not in the list of rooms with active doctors
     rooms_with_no_doctors = (Room
-                             .select()
+                             .select(Room.id)
                              .where(Room.id.not_in(active_doctors_rooms)))
 
-    # Fetch full room details using an existing function assumed to fetch detailed room information
-    room_list = []
-    for room in rooms_with_no_doctors:
-        room_data = get_room(room.id)
-        room_list.append(room_data)
-
-    return room_list
+    # Fetch full room details in bulk
+    return get_rooms([room.id for room in rooms_with_no_doctors])
 
 def get_step2_rooms(doctor_id):
     """
@@ -242,13 +303,8 @@ def get_step2_rooms(doctor_id):
                     .select(DoctorInRoom.room)
                     .where((DoctorInRoom.doctor == doctor_id) & (DoctorInRoom.enabled == True)))
 
-    # Fetch full room details using an assumed function `get_room` for fetching detailed room information
-    room_list = []
-    for doctor_in_room in rooms_joined:
-        room_data = get_room(doctor_in_room.room.id)
-        room_list.append(room_data)
-
-    return room_list
+    # Fetch full room details in bulk
+    return get_rooms([doctor_in_room.room_id for doctor_in_room in rooms_joined])
 
 def get_step3_rooms(doctor_id):
     """
@@ -267,15 +323,10 @@ def get_step3_rooms(doctor_id):
 
     # Main query to select rooms where there is a second opinion request for this doctor and the doctor hasn't joined the room
     target_rooms = (Room
-                    .select()
+                    .select(Room.id)
                     .join(SecondOpinionRequest, on=(Room.id == SecondOpinionRequest.room))
                     .where((SecondOpinionRequest.second_opinion_doctor == doctor_id) &
                            (Room.id.not_in(joined_rooms))))
 
-    # Fetch full room details using an assumed function `get_room` for fetching detailed room information
-    room_list = []
-    for room in target_rooms:
-        room_data = get_room(room.id)
-        room_list.append(room_data)
-
-    return room_list
+    # Fetch full room details in bulk
+    return get_rooms([room.id for room in target_rooms])
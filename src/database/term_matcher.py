@@ -0,0 +1,237 @@
+# src/database/term_matcher.py
+"""
+In-process dictionary of the known medical terms, built from MedicalTermSynonym.
+
+An Aho-Corasick automaton finds every known synonym in a message in a single pass over the text. Text and synonyms are
+compared after NFKC normalisation and case folding. Matches in scripts written with spaces must sit on word
+boundaries; CJK text has none, so CJK synonyms match anywhere.
+
+The words the LLM has looked at without finding a term in them are remembered as well, for NON_TERM_TTL seconds, so that
+a message made only of known terms and known other words does not need the LLM at all (see unknown_candidates).
+"""
+import threading
+import unicodedata
+from typing import NamedTuple
+
+from .data_models import MedicalTermSynonym
+from ..cache import LRUCache
+from ..glovars import NON_TERM_TTL, NON_TERM_CACHE_SIZE
+
+
+class TermMatch(NamedTuple):
+    start: int  # position in the original text
+    end: int
+    term_id: int
+    synonym_id: int
+
+
+def is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (0x3040 <= code <= 0x30FF or  # Hiragana, Katakana
+            0x31F0 <= code <= 0x31FF or  # Katakana phonetic extensions
+            0x3400 <= code <= 0x4DBF or  # CJK extension A
+            0x4E00 <= code <= 0x9FFF or  # CJK unified ideographs
+            0xF900 <= code <= 0xFAFF or  # CJK compatibility ideographs
+            0x1100 <= code <= 0x11FF or  # Hangul jamo
+            0x3130 <= code <= 0x318F or  # Hangul compatibility jamo
+            0xAC00 <= code <= 0xD7AF)  # Hangul syllables
+
+
+def is_hiragana(char: str) -> bool:
+    return 0x3040 <= ord(char) <= 0x309F
+
+
+def is_word_char(char: str) -> bool:
+    return char.isalnum() and not is_cjk(char)
+
+
+def split_words(text: str) -> list[str]:
+    """
+    Runs of letters of spaced scripts, and runs of kanji, katakana and hangul. Digits, punctuation and hiragana
+    (grammar, in Japanese) are separators.
+    """
+    words = []
+    word = ''
+    word_is_cjk = False
+    for char in text:
+        char_is_cjk = is_cjk(char) and not is_hiragana(char)
+        if not char_is_cjk and not (char.isalpha() and not is_cjk(char)):
+            char_is_cjk = None  # separator
+
+        if word and char_is_cjk is not word_is_cjk:
+            words.append(word)
+            word = ''
+        if char_is_cjk is not None:
+            word += char
+            word_is_cjk = char_is_cjk
+
+    if word:
+        words.append(word)
+
+    return words
+
+
+def normalize(text: str) -> tuple[str, list[int]]:
+    """
+    :return: (normalized text, position in the original text of each normalized character)
+    """
+    chars = []
+    positions = []
+    for i, char in enumerate(text):
+        for normalized_char in unicodedata.normalize('NFKC', char).casefold():
+            chars.append(normalized_char)
+            positions.append(i)
+
+    return ''.join(chars), positions
+
+
+class TermMatcher:
+    def __init__(self):
+        # normalized synonym -> (term id, synonym id)
+        self.patterns: dict[str, tuple[int, int]] = {}
+        # normalized word -> True
+        self.non_terms = LRUCache(NON_TERM_CACHE_SIZE, NON_TERM_TTL)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[str]] = [[]]
+        self._stale = True
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self) -> None:
+        """
+        (Re)load all the synonyms from the database.
+        """
+        with self._lock:
+            self.patterns = {}
+            for synonym in MedicalTermSynonym.select().order_by(MedicalTermSynonym.id):
+                self._add(synonym.synonym, synonym.medical_term_id, synonym.id)
+            self._loaded = True
+            self._stale = True
+
+    def sync_term(self, term_id: int) -> None:
+        """
+        Reload the synonyms of one medical term after it was created, updated or deleted.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+
+            self._remove(term_id)
+            synonyms = (MedicalTermSynonym.select()
+                        .where(MedicalTermSynonym.medical_term == term_id)
+                        .order_by(MedicalTermSynonym.id))
+            for synonym in synonyms:
+                self._add(synonym.synonym, term_id, synonym.id)
+            self._stale = True
+
+    def find(self, text: str) -> list[TermMatch]:
+        """
+        Leftmost-longest, non overlapping matches of the known synonyms in text.
+        """
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            if self._stale:
+                self._build()
+
+            # The automaton was just built from self.patterns, which sync_term rebinds: take both at once
+            goto, fail, output, patterns = self._goto, self._fail, self._output, self.patterns
+
+        normalized, positions = normalize(text)
+        candidates = []
+        state = 0
+        for i, char in enumerate(normalized):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for pattern in output[state]:
+                start = i - len(pattern) + 1
+                if self._on_boundaries(normalized, start, i + 1):
+                    candidates.append((start, i + 1, pattern))
+
+        matches = []
+        last_end = 0
+        for start, end, pattern in sorted(candidates, key=lambda candidate: (candidate[0], -candidate[1])):
+            if start < last_end:
+                continue
+
+            term_id, synonym_id = patterns[pattern]
+            matches.append(TermMatch(positions[start], positions[end - 1] + 1, term_id, synonym_id))
+            last_end = end
+
+        return matches
+
+    def unknown_candidates(self, text: str, matches: list[TermMatch]) -> list[str]:
+        """
+        Words of the text outside the matches that could still be unknown medical terms, i.e. that are not known
+        other words. CJK words are the runs of kanji, katakana and hangul; hiragana is left out as it is grammar.
+        """
+        chars = list(text)
+        for match in matches:
+            chars[match.start:match.end] = ' ' * (match.end - match.start)
+        residual, _ = normalize(''.join(chars))
+
+        return [word for word in split_words(residual) if self.non_terms.get(word) is None]
+
+    def learn_non_terms(self, candidates: list[str], terms: list[str]) -> None:
+        """
+        Remember the candidates that are not part of any of the terms the LLM found in the same text.
+        """
+        normalized_terms = [normalize(term)[0] for term in terms]
+        for candidate in candidates:
+            if not any(candidate in term or term in candidate for term in normalized_terms):
+                self.non_terms.set(candidate, True)
+
+    @staticmethod
+    def _on_boundaries(text: str, start: int, end: int) -> bool:
+        if start > 0 and is_word_char(text[start]) and is_word_char(text[start - 1]):
+            return False
+        if end < len(text) and is_word_char(text[end - 1]) and is_word_char(text[end]):
+            return False
+
+        return True
+
+    def _add(self, synonym: str, term_id: int, synonym_id: int) -> None:
+        pattern, _ = normalize(synonym.strip())
+        if pattern and pattern not in self.patterns:
+            self.patterns[pattern] = (term_id, synonym_id)
+
+    def _remove(self, term_id: int) -> None:
+        self.patterns = {
+            pattern: ids for pattern, ids in self.patterns.items() if ids[0] != term_id
+        }
+
+    def _build(self) -> None:
+        # Caller holds self._lock. Trie first, then the failure links breadth first.
+        goto: list[dict[str, int]] = [{}]
+        output: list[list[str]] = [[]]
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto.append({})
+                    output.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            output[state].append(pattern)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                if fail[next_state] == next_state:
+                    fail[next_state] = 0
+                output[next_state] = output[next_state] + output[fail[next_state]]
+
+        self._goto, self._fail, self._output = goto, fail, output
+        self._stale = False
+
+
+matcher = TermMatcher()
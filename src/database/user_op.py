@@ -2,9 +2,30 @@
 from peewee import DoesNotExist
 from datetime import datetime, timedelta
 
+import threading
+
 from .data_models import BaseUser, Doctor, Patient, Session
+from .. import invalidation
+from ..cache import LRUCache
 from ..utils import salted_hash, gen_session_token
-from ..glovars import PATIENT, DOCTOR
+from ..glovars import PATIENT, DOCTOR, SESSION_CACHE_TTL, SESSION_CACHE_SIZE
+
+"""
+session_cache = {
+    'token': ({
+        'userId': 1,
+        'name': 'John Doe',
+        'language': 'en',
+        'type': 'PATIENT',
+        'expirationTime': datetime
+    }, 0)  # version of the user when cached
+}
+"""
+session_cache = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+# user id -> version, bumped when the user changes so that their cached sessions are no longer used. Only the users
+# changed since the start are in it
+_user_versions: dict[int, int] = {}
+_user_versions_lock = threading.Lock()
 
 
 def email_exists(email: str) -> bool:
@@ -92,6 +113,35 @@ def get_user_full(user_id: int) -> dict:
     dict: User details
     """
     base_user = BaseUser.get(BaseUser.id == user_id)
+    if base_user.user_type == PATIENT:
+        return user_full_dict(base_user, patient=base_user.patient[0])
+
+    return user_full_dict(base_user, doctor=base_user.doctor[0])
+
+
+def get_users_full(user_ids: list[int]) -> dict[int, dict]:
+    """
+    Get full details of several users in three queries.
+
+    Parameters:
+    user_ids (list): IDs of the users
+
+    Returns:
+    dict: User details in the format of get_user_full, by user ID. Missing users are left out
+    """
+    if not user_ids:
+        return {}
+
+    patients = {patient.base_user_id: patient for patient in Patient.select().where(Patient.base_user.in_(user_ids))}
+    doctors = {doctor.base_user_id: doctor for doctor in Doctor.select().where(Doctor.base_user.in_(user_ids))}
+
+    return {
+        base_user.id: user_full_dict(base_user, patients.get(base_user.id), doctors.get(base_user.id))
+        for base_user in BaseUser.select().where(BaseUser.id.in_(user_ids))
+    }
+
+
+def user_full_dict(base_user: BaseUser, patient: Patient | None = None, doctor: Doctor | None = None) -> dict:
     ret = {
         'userId': base_user.id,
         "email": base_user.email,
@@ -101,15 +151,13 @@ def get_user_full(user_id: int) -> dict:
     }
 
     if base_user.user_type == PATIENT:
-        patient = base_user.patient[0]
         ret['type'] = 'PATIENT'
-        ret['height'] = patient.height
-        ret['weight'] = patient.weight
+        ret['height'] = patient.height if patient else None
+        ret['weight'] = patient.weight if patient else None
     else:
-        doctor = base_user.doctor[0]
         ret['type'] = 'DOCTOR'
-        ret['hospital'] = doctor.hospital
-        ret['specialisation'] = doctor.specialisation
+        ret['hospital'] = doctor.hospital if doctor else None
+        ret['specialisation'] = doctor.specialisation if doctor else None
 
     return ret
 
@@ -166,6 +214,68 @@ def get_session_by_token(token) -> dict | None:
     }
 
 
+def get_auth_by_token(token) -> dict | None:
+    """
+    Get (user id, name, language code, user type, expiration time) of a session in a single query, cached for
+    SESSION_CACHE_TTL seconds. Used to authenticate every request.
+
+    Returns:
+    dict: {'userId': 1, 'name': 'John Doe', 'language': 'en', 'type': 'PATIENT', 'expirationTime': datetime}, or None
+    """
+    cached = session_cache.get(token)
+    if cached is not None:
+        auth, version = cached
+        if version == _user_versions.get(auth['userId'], 0):
+            return auth
+
+    try:
+        session = (Session.select(Session, BaseUser)
+                   .join(BaseUser)
+                   .where(Session.token == token)
+                   .get())
+    except DoesNotExist:
+        return None
+
+    auth = {
+        'userId': session.user.id,
+        'name': session.user.name,
+        'language': session.user.language_code,
+        'type': 'PATIENT' if session.user.user_type == PATIENT else 'DOCTOR',
+        'expirationTime': session.valid_until
+    }
+    session_cache.set(token, (auth, _user_versions.get(auth['userId'], 0)))
+    return auth
+
+
+def _drop_user_sessions(user_id: int):
+    with _user_versions_lock:
+        _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+
+
+invalidation.register('user', _drop_user_sessions)
+invalidation.register('session', session_cache.delete)
+
+
+def invalidate_user_sessions(user_id: int):
+    """
+    Stop using the cached sessions of a user on every instance, after the user is updated or deleted. They are
+    refreshed on their next use, or evicted.
+    """
+    invalidation.publish('user', user_id)
+
+
+def delete_session(token: str) -> bool:
+    """
+    Log out: delete a session and its cache entry on every instance.
+
+    Returns:
+    bool: True if the session existed
+    """
+    deleted = Session.delete().where(Session.token == token).execute() > 0
+    invalidation.publish('session', token)
+    return deleted
+
+
 def update_user(user_id: int, user_update_info: dict):
     """
     Update user details.
@@ -218,6 +328,7 @@ def update_user(user_id: int, user_update_info: dict):
         doctor.save()
 
     base_user.save()
+    invalidate_user_sessions(user_id)
     return base_user
 
 
@@ -230,6 +341,7 @@ def delete_user(user_id: int):
     """
     base_user = BaseUser.get(BaseUser.id == user_id)
     base_user.delete_instance()
+    invalidate_user_sessions(user_id)
 
 def get_all_doctors() -> list:
     """
@@ -0,0 +1,119 @@
+# src/invalidation.py
+"""
+Each instance keeps caches of data any instance can change: sessions, room memberships, and the medical terms of the
+term matcher and of the term cache. A change is applied to the caches of this instance, and published for the other
+instances to apply it to theirs:
+
+    invalidation.register('session', drop_session)  # at import, by the module owning the cache
+    invalidation.publish('session', token)  # where the data changes
+
+INVALIDATION_URL selects the channel: `local` with a single instance, where there is nobody to tell, or
+`redis://host:6379/0` to publish on a Redis channel all the instances listen to. It defaults to SOCKETIO_MESSAGE_QUEUE
+when that is a Redis URL.
+"""
+import json
+import threading
+import time
+import uuid
+from typing import Callable
+
+from .glovars import INVALIDATION_URL
+from .utils import print_info
+
+CHANNEL = 'heal:invalidation'
+
+# kind -> handler, called with the arguments of publish
+handlers: dict[str, Callable] = {}
+
+
+def register(kind: str, handler: Callable) -> None:
+    handlers[kind] = handler
+
+
+def publish(kind: str, *args) -> None:
+    """
+    Apply a change to the caches of this instance, then to the ones of the other instances. The arguments must be
+    JSON serialisable.
+    """
+    handlers[kind](*args)
+    channel.send(kind, list(args))
+
+
+def listen(context: Callable) -> None:
+    """
+    Start applying what the other instances publish.
+    :param context: context manager the handlers run in, like a database connection
+    """
+    channel.listen(context)
+
+
+class LocalChannel:
+    def send(self, kind: str, args: list) -> None:
+        pass
+
+    def listen(self, context: Callable) -> None:
+        pass
+
+
+class RedisChannel:
+    RETRY_DELAY = 1  # seconds before subscribing again after losing Redis
+
+    def __init__(self, url: str):
+        import redis  # only needed with a redis:// INVALIDATION_URL
+
+        self.redis = redis.Redis.from_url(url)
+        self.instance_id = uuid.uuid4().hex  # to skip what this instance published
+        self._listening = False
+
+    def send(self, kind: str, args: list) -> None:
+        self.redis.publish(CHANNEL, json.dumps({'instance': self.instance_id, 'kind': kind, 'args': args}))
+
+    def listen(self, context: Callable) -> None:
+        """
+        Apply what the other instances publish, in a daemon thread (a greenlet under gevent or eventlet).
+        """
+        if self._listening:
+            return
+
+        self._listening = True
+        self._context = context
+        threading.Thread(target=self._listen_forever, name='invalidation', daemon=True).start()
+
+    def _listen_forever(self) -> None:
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for message in pubsub.listen():
+                    self._apply(message['data'])
+            except Exception as e:
+                # Changes published meanwhile are missed: the caches' TTL bounds how long they stay stale
+                print_info(f'Invalidation channel lost: {e}')
+                time.sleep(self.RETRY_DELAY)
+
+    def _apply(self, data: bytes) -> None:
+        message = json.loads(data)
+        if message['instance'] == self.instance_id:
+            return
+
+        handler = handlers.get(message['kind'])
+        if handler is None:
+            return
+
+        try:
+            with self._context():
+                handler(*message['args'])
+        except Exception as e:
+            print_info(f'Invalidation {message["kind"]} {message["args"]} failed: {e}')
+
+
+def make_channel(url: str):
+    if url == 'local':
+        return LocalChannel()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisChannel(url)
+
+    raise ValueError(f'Unsupported INVALIDATION_URL: {url}')
+
+
+channel = make_channel(INVALIDATION_URL)
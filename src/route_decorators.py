@@ -97,13 +97,12 @@ def login_required(func):
             unauth_error['message'] = 'No Authorization Token'
             return unauth_error, 401
 
-        session = db.user.get_session_by_token(token)
-        if session is None or session['expirationTime'] < datetime.now():
+        auth = db.user.get_auth_by_token(token)
+        if auth is None or auth['expirationTime'] < datetime.now():
             unauth_error['message'] = 'User invalid'
             return unauth_error, 401
 
-        user_data = db.user.get_user_full(session['userId'])
-        language_code = user_data.get('language', 'en')
+        language_code = auth['language'] or 'en'
 
-        return func(session['userId'], language_code, *args, **kwargs)
+        return func(auth['userId'], language_code, *args, **kwargs)
     return new_func
@@ -7,6 +7,7 @@ from . import app
 from .route_decorators import required_body_items, required_params, login_required
 from .utils import salted_hash
 from . import database as db
+from . import GPT, url_verifier
 
 
 # User Management
@@ -217,6 +218,20 @@ def login():
         }
 
 
+@app.route('/users/logout', methods=['POST'])
+@login_required
+def logout(_, __):
+    """
+    Log out the user: the token in the Authorization header is no longer valid.
+
+    Response:
+    204 No Content
+    """
+    token = request.headers.get('Authorization', '').split(' ')[1]
+    db.user.delete_session(token)
+    return '', 204
+
+
 @app.route('/users/verify-token', methods=['GET'])
 @login_required
 def verify_token(user_id, __):
@@ -439,7 +454,7 @@ def get_requested_rooms(user_id, _):
 
 # Message Management
 @app.route('/chats/<int:room_id>/messages', methods=['GET'])
-@required_params(['page', 'limit'])
+@required_params(['limit'])
 @login_required
 def get_chat_messages(_, language_code, room_id):
     """
@@ -449,8 +464,17 @@ def get_chat_messages(_, language_code, room_id):
     room_id: int - ID of the room
 
     Request Parameters:
-    page: int - Page number
     limit: int - Number of messages per page
+    page: int - Page number
+    or, for keyset pagination,
+    before: str - Cursor. Messages older than it. Empty to start from the latest message
+    after: str - Cursor. Messages newer than it
+
+    With `before` or `after`, the response is
+    {
+        "messages": [ ...same as below... ],
+        "nextCursor": "MTI"  // null when there are no more messages
+    }
 
     Response:
     {
@@ -487,11 +511,27 @@ def get_chat_messages(_, language_code, room_id):
     }
     200 OK
     """
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if before is None and after is None and request.args.get('page') is None:
+        return {
+            "error": "Missing items.",
+            "missing": ['page']
+        }, 406
+
     try:
-        page_num = int(request.args.get('page'))
         limit_num = int(request.args.get('limit'))
+        if limit_num <= 0:
+            raise ValueError(f'Invalid limit: {limit_num}')
+        if before is not None or after is not None:
+            data = db.message_op.get_chat_messages_by_cursor(room_id, limit_num, language_code, before, after)
+            return jsonify(data)
+
+        page_num = int(request.args.get('page'))
         data = db.message_op.get_chat_messages(room_id, page_num, limit_num, language_code)
         return jsonify(data)
+    except ValueError as e:
+        return jsonify({'error': 'valueError', 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'error': 'Internal Server Error'}), 500
 
@@ -585,6 +625,11 @@ def create_term(_, __):
     try:
         new_term_id = db.message_op.create_term(term_type, term_info_list)
         return {'termId': new_term_id}, 201
+    except IntegrityError as e:
+        return {
+            'error': 'conflictError',
+            'message': f'A synonym already belongs to another term: {e}'
+        }, 409
     except Exception as e:
         return {
             'error': 'ServerError',
@@ -690,7 +735,13 @@ def operate_single_term(_, language_code, medical_term_id):
 
     if request.method == 'PUT':
         medical_term_info = request.get_json()
-        data = db.message_op.update_term(medical_term_id, medical_term_info, language_code)
+        try:
+            data = db.message_op.update_term(medical_term_id, medical_term_info, language_code)
+        except IntegrityError as e:
+            return {
+                'error': 'conflictError',
+                'message': f'A synonym already belongs to another term: {e}'
+            }, 409
         return data
 
     if request.method == 'DELETE':
@@ -1270,4 +1321,50 @@ def add_second_opinion_doctor(_, __, room_id, doctor_id):
         return {
             "error": "ServerError",
             "message": str(e)
-        }, 500
\ No newline at end of file
+        }, 500
+
+# Monitoring
+@app.route('/status', methods=['GET'])
+@login_required
+def get_status(user_id, _):
+    """
+    Counters of the GPT calls and of the result caches of this instance, since it started.
+
+    Response:
+    {
+        "gpt": {
+            "calls": 120,  # attempts, retries included
+            "retries": 3,
+            "failures": 1,  # calls given up, and broken streams
+            "fastFailures": 0,  # calls refused while the circuit was open
+            "circuitState": "closed",
+            "circuitOpenCount": 0,
+            "circuitOpenSeconds": 0.0,
+            "coalesced": 7  # calls served by an identical one in flight
+        },
+        "caches": {
+            "translation": {"hits": 10, "misses": 5, "memory": {"hits": 8, "misses": 7, "size": 5}},
+            "term": {...},
+            "url": {...}
+        }
+    }
+    200 OK
+    """
+    user_data = db.user.get_user_full(user_id)
+    if user_data['type'] != 'DOCTOR':
+        return {
+            "error": "forbiddenError",
+            "message": "Only doctors can access this endpoint."
+        }, 403
+
+    return {
+        "gpt": {
+            **GPT.get_metrics(),
+            "coalesced": GPT.single_flight.flights.coalesced
+        },
+        "caches": {
+            "translation": GPT.translator.translation_cache.stats(),
+            "term": GPT.term_cache.term_cache.stats(),
+            "url": url_verifier.url_cache.stats()
+        }
+    }, 200
@@ -0,0 +1,68 @@
+# src/session_registry.py
+import threading
+
+
+class WsSession:
+    """
+    A connected Socket.IO client. Only what the handlers need is kept, to stay small with many connections.
+    """
+    __slots__ = ('sid', 'room_id', 'user_id', 'name', 'language', 'user_type')
+
+    def __init__(self, sid: str, room_id: int, user_id: int, name: str, language: str, user_type: str):
+        self.sid = sid
+        self.room_id = room_id
+        self.user_id = user_id
+        self.name = name
+        self.language = language
+        self.user_type = user_type  # 'PATIENT' or 'DOCTOR'
+
+
+class SessionRegistry:
+    """
+    Connected sessions by sid, with secondary indexes by room id and by user id. All operations are O(1), apart from
+    listing the sessions of a room or a user.
+    """
+
+    def __init__(self):
+        self._by_sid: dict[str, WsSession] = {}
+        self._by_room: dict[int, dict[str, WsSession]] = {}
+        self._by_user: dict[int, dict[str, WsSession]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, session: WsSession) -> None:
+        with self._lock:
+            self._by_sid[session.sid] = session
+            self._by_room.setdefault(session.room_id, {})[session.sid] = session
+            self._by_user.setdefault(session.user_id, {})[session.sid] = session
+
+    def get(self, sid: str) -> WsSession | None:
+        return self._by_sid.get(sid)
+
+    def remove(self, sid: str) -> WsSession | None:
+        with self._lock:
+            session = self._by_sid.pop(sid, None)
+            if session is None:
+                return None
+
+            self._discard(self._by_room, session.room_id, sid)
+            self._discard(self._by_user, session.user_id, sid)
+            return session
+
+    def in_room(self, room_id: int) -> list[WsSession]:
+        return list(self._by_room.get(room_id, {}).values())
+
+    def of_user(self, user_id: int) -> list[WsSession]:
+        return list(self._by_user.get(user_id, {}).values())
+
+    def __len__(self):
+        return len(self._by_sid)
+
+    @staticmethod
+    def _discard(index: dict, key: int, sid: str) -> None:
+        sessions = index.get(key)
+        if sessions is None:
+            return
+
+        sessions.pop(sid, None)
+        if not sessions:
+            del index[key]
@@ -0,0 +1,89 @@
+# src/url_verifier.py
+"""
+Checks that the reference URLs of medical terms are reachable, with HEAD requests over a shared connection pool and
+short timeouts. Results are cached: reachable URLs for URL_CACHE_TTL seconds, unreachable ones for the shorter
+URL_CACHE_NEGATIVE_TTL, as a site may only be down for a while.
+"""
+import threading
+import time
+
+import httpx
+
+from .cache import PersistentCache, hash_key
+from .glovars import (
+    CACHE_DB_PATH, URL_CHECK_TIMEOUT, URL_CHECK_CONNECT_TIMEOUT, URL_CHECK_MAX_CONNECTIONS, URL_CACHE_TTL,
+    URL_CACHE_NEGATIVE_TTL
+)
+from .utils import print_info
+
+# Servers that do not support HEAD
+HEAD_UNSUPPORTED_STATUS_CODES = (405, 501)
+
+url_cache = PersistentCache(CACHE_DB_PATH, 'url', max_memory_items=4096, ttl=URL_CACHE_TTL)
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> httpx.Client:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    timeout=httpx.Timeout(URL_CHECK_TIMEOUT, connect=URL_CHECK_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(max_connections=URL_CHECK_MAX_CONNECTIONS),
+                    follow_redirects=True,
+                    headers={'User-Agent': 'Mozilla/5.0 (compatible; HEAL link checker)'}
+                )
+
+    return _client
+
+
+def cached_result(url: str) -> bool | None:
+    """
+    :return: the cached result of check_url, or None if the URL has not been checked recently
+    """
+    if not url:
+        return False
+
+    result = url_cache.get(hash_key(url))
+    if result is None:
+        return None
+
+    if not result['valid'] and time.time() - result['checkedAt'] > URL_CACHE_NEGATIVE_TTL:
+        return None
+
+    return result['valid']
+
+
+def check_url(url: str | None) -> bool:
+    """
+    Whether the URL points to an existing page. Blocks for at most about URL_CHECK_TIMEOUT seconds when not cached.
+    """
+    if not url or not url.startswith(('http://', 'https://')):
+        return False
+
+    valid = cached_result(url)
+    if valid is not None:
+        return valid
+
+    valid = request_url(url)
+    url_cache.set(hash_key(url), {'valid': valid, 'checkedAt': time.time()})
+    return valid
+
+
+def request_url(url: str) -> bool:
+    client = get_client()
+    try:
+        response = client.head(url)
+        if response.status_code in HEAD_UNSUPPORTED_STATUS_CODES:
+            # Only the status line and the headers are read
+            with client.stream('GET', url) as response:
+                pass
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        print_info(f'URL check failed for {url}: {e!r}')
+        return False
+
+    # Sites that forbid unknown clients still have the page
+    return response.status_code < 400 or response.status_code == 403
@@ -1,48 +1,58 @@
 # src/websocket.py
+import uuid
+import weakref
 from datetime import datetime
+from threading import BoundedSemaphore
 
 from flask import request
 from flask_socketio import emit, disconnect, join_room
 
 from . import socketio
 from . import database as db
+from .bot_state import bot_states, load_bot_state
+from .glovars import ASYNC_PIPELINE, ROOM_ENRICH_CONCURRENCY, STREAM_AI_DOCTOR, URL_CHECK_ASYNC, TRANSLATION_FAN_OUT
+from .session_registry import SessionRegistry, WsSession
+from .utils import print_info
 from src import GPT
 
-"""
-wsSession = [{
-    'user': db.user.get_user_full(user_id),
-    'roomId': roomId,
-    'sid': sid
-}]
-"""
-wsSessions = []
+# Connected sessions, by sid, room id and user id
+wsSessions = SessionRegistry()
 
 """
-chatBots = {
-    3: <ChatBot>,
-    16: <ChatBot>,
+Bounds the background enrichments running at the same time for each room. A semaphore is dropped once no task holds
+it, so that only the rooms with enrichments running or waiting have one.
+roomSemaphores = {
+    3: <BoundedSemaphore>,
     ...
 }
 """
-chatBots = {}
+roomSemaphores = weakref.WeakValueDictionary()
 
 
-def get_session() -> dict:
-    global wsSessions
-    # get session from wsSession by session[sid]
+def language_room(roomId: int, lan: str) -> str:
+    """
+    SocketIO room of the users of a room who speak lan, so that each gets messages in their own language. Being a
+    SocketIO room, it works across instances as well.
+    """
+    return f'{roomId}:{lan}'
+
+
+def get_session() -> WsSession:
     sid = request.sid  # type: ignore
-    try:
-        return list(filter(lambda session: session['sid'] == sid, wsSessions))[0]
-    except IndexError:
+    session = wsSessions.get(sid)
+    if session is None:
         emit('error', {
             'error': 'InternalServerError',
             'message': 'User is authenticated. However, no registered sid is found.'
         })
         disconnect()
-        raise
+        raise LookupError(f'No registered session for sid {sid}')
+
+    return session
 
 
 @socketio.on('connect')
+@db.connection_context()
 def connect(auth: dict):
     token = auth.get('token')
     roomId = auth.get('roomId')
@@ -53,7 +63,7 @@ def connect(auth: dict):
     }
 
     # Check if logged in
-    session = db.user.get_session_by_token(token)
+    session = db.user.get_auth_by_token(token)
     if session and session['expirationTime'] < datetime.now():
         session = None
 
@@ -64,42 +74,46 @@ def connect(auth: dict):
         return
 
     # Check if in room
-    rooms = db.room_op.get_rooms_all_fixed(session['userId'])['rooms']
-    roomIds = list(map(lambda room: room.get('roomId'), rooms))
-
-    if roomId not in roomIds:
+    if not isinstance(roomId, int) or not db.room_op.is_member(session['userId'], roomId):
         unauthError['message'] = 'Room invalid'
         emit('error', unauthError)
         disconnect()
         return
 
-    # Add user to SocketIO room of roomId
+    # Add user to SocketIO room of roomId, and to the one of their language
     join_room(roomId)
+    join_room(language_room(roomId, session['language']))
 
-    wsSessions.append({
-        'user': db.user.get_user_full(session['userId']),
-        'roomId': roomId,
-        'sid': sid
-    })
+    wsSessions.add(WsSession(
+        sid,
+        roomId,
+        session['userId'],
+        session['name'],
+        session['language'],
+        session['type']
+    ))
 
 
 @socketio.on('disconnect')
+@db.connection_context()
 def on_disconnect():
-    global wsSessions
+    session = wsSessions.get(request.sid)  # type: ignore
+    if session is None:
+        # The connection was rejected
+        return
 
-    session = get_session()
     print(f"User disconnected:\n"
-          f"    User ID: {session['user']['userId']};"
-          f"    User Name: {session['user']['name']}.")
+          f"    User ID: {session.user_id};"
+          f"    User Name: {session.name}.")
 
     # leaving rooms is done by the framework
-    wsSessions.remove(session)
+    wsSessions.remove(session.sid)
 
 
-def save_client_message(session: dict, text: str, time_iso_format: str) -> int:
+def save_client_message(session: WsSession, text: str, time_iso_format: str) -> int:
     message_id = db.message_op.save_message_only(
-        session['user']['userId'],
-        session['roomId'],
+        session.user_id,
+        session.room_id,
         text,
         datetime.fromisoformat(time_iso_format)
     )
@@ -107,107 +121,337 @@ def save_client_message(session: dict, text: str, time_iso_format: str) -> int:
     return message_id
 
 
-def analyze_terms(text: str, text_lan: str) -> list[(int, int)]:
+def analyze_terms(text: str, text_lan: str) -> tuple[list[(int, int)], list[dict]]:
     """
-    1. Get terms by GPT.
-    2. If terms exists in the database, send the data stored in the database.
-    3. If terms does not exist, ask GPT for information and possible wiki links of the term. Send the data, and
-        store them in the database.
-    :return: list of (term_id, synonym_id)
+    1. Find the known terms with the local term matcher. If the rest of the text is only known other words, stop here.
+    2. Otherwise get terms, along with their explanations, by one GPT call, and look all their synonyms up at once.
+    3. If terms exists in the database, note their id.
+    4. If terms does not exist, ask GPT for information and possible wiki links of the term.
+    Nothing is written here, so that no transaction waits for GPT: store the terms with store_terms.
+    :return: (term_id, synonym_id) of the terms found by the matcher, and the terms found by GPT, each with its
+        "termId", or None and its "explanation" if it is new
     """
 
-    term_pairs = []
-    terms = GPT.extract_medical_term(text_lan, text)
+    matches = db.term_matcher.matcher.find(text)
+    term_pairs = [(match.term_id, match.synonym_id) for match in matches]
+    candidates = db.term_matcher.matcher.unknown_candidates(text, matches)
+    if not candidates:
+        return term_pairs, []
+
+    with db.released_connection():
+        terms = GPT.analyze_medical_terms(text_lan, text)
+    names = {name for term in terms for name in [term['term'], *term['synonyms']]}
+    owners = {}
+    for synonym in (db.data_models.MedicalTermSynonym.select()
+                    .where((db.data_models.MedicalTermSynonym.synonym.in_(list(names))) &
+                           (db.data_models.MedicalTermSynonym.language_code == text_lan))
+                    .order_by(db.data_models.MedicalTermSynonym.id)):
+        owners.setdefault(synonym.synonym, synonym.medical_term_id)
+
     for term in terms:
-        found_synonyms = []
-        for synonym in term['synonyms']:
-            found_synonyms += list(db.data_models.MedicalTermSynonym.select()
-                                   .where(db.data_models.MedicalTermSynonym.synonym == synonym))
-
-        if len(found_synonyms) == 0:
-            # It's new. So search for explanation, and save
-            term_explanation = GPT.explain_medical_term(text_lan, term['term'])
-            term_id = db.data_models.MedicalTerm.create(term_type=term_explanation['type']).id
-            db.data_models.MedicalTermInfo.create(
-                medical_term=term_id,
-                language_code=text_lan,
-                name=term['term'],
-                description=term_explanation['description'],
-                url=term_explanation['url']
-            )
-        else:
-            term_id = found_synonyms[0].medical_term
-
-        stored_synonyms = (db.data_models.MedicalTermSynonym.select()
-                           .where(db.data_models.MedicalTermSynonym.medical_term == term_id))
-        new_synonyms = [synonym for synonym in term['synonyms'] if synonym not in stored_synonyms]
-        for new_syn in new_synonyms:
-            db.data_models.MedicalTermSynonym.create(
-                medical_term=term_id,
-                synonym=new_syn,
-                language_code=text_lan
+        term['termId'] = next(
+            (owners[name] for name in [*term['synonyms'], term['term']] if name in owners), None
+        )
+        if term['termId'] is None:
+            # It's new. So search for explanation. Unless already known, the URL is filled in afterwards
+            term['candidateUrl'] = (term.get('explanation') or {}).get('url')
+            with db.released_connection():
+                term['explanation'] = GPT.explain_analyzed_term(text_lan, term, check_url=not URL_CHECK_ASYNC)
+
+    db.term_matcher.matcher.learn_non_terms(candidates, [term['term'] for term in terms])
+    return term_pairs, terms
+
+
+def store_terms(terms: list[dict], text_lan: str) -> tuple[list[(int, int)], set[int]]:
+    """
+    Create the new terms from analyze_terms, and add the synonyms the others do not have yet. To be called in a
+    transaction.
+    :return: (term_id, synonym_id) of each term, and the ids of the terms created or given synonyms, to refresh once
+        committed
+    """
+    if not terms:
+        return [], set()
+
+    touched_ids = set()
+    new_synonyms = {}
+    for term in terms:
+        if term['termId'] is None:
+            # Another message may have created the same term meanwhile; then that one is used
+            term['termId'], term['created'] = db.message_op.create_analyzed_term(
+                text_lan, term['term'], term['synonyms'], term['explanation']
             )
+            if term['created']:
+                touched_ids.add(term['termId'])
+            continue
+
+        for synonym in [term['term'], *term['synonyms']]:
+            new_synonyms.setdefault(synonym, term['termId'])
+
+    def synonyms_in(names: list[str]) -> dict:
+        return {synonym.synonym: synonym for synonym in (db.data_models.MedicalTermSynonym.select()
+                .where((db.data_models.MedicalTermSynonym.synonym.in_(names)) &
+                       (db.data_models.MedicalTermSynonym.language_code == text_lan)))}
+
+    stored = synonyms_in([term['term'] for term in terms] + list(new_synonyms))
+    rows = [
+        {'medical_term': term_id, 'synonym': synonym, 'language_code': text_lan}
+        for synonym, term_id in new_synonyms.items() if synonym not in stored
+    ]
+    if rows:
+        # A synonym is unique per language: one just added by another message stays with its term
+        db.data_models.MedicalTermSynonym.insert_many(rows).on_conflict_ignore().execute()
+        touched_ids.update(row['medical_term'] for row in rows)
+        stored.update(synonyms_in([row['synonym'] for row in rows]))
+
+    return [(term['termId'], stored[term['term']].id) for term in terms], touched_ids
+
+
+def current_term_pairs(term_pairs: list[(int, int)]) -> list[(int, int)]:
+    """
+    Keep the (term_id, synonym_id) pairs of the matcher whose synonym still belongs to the term: it may have been
+    changed or deleted since, on another instance. The matcher reloads the terms of the others. To be called in a
+    transaction.
+    """
+    if not term_pairs:
+        return []
+
+    synonym = db.data_models.MedicalTermSynonym
+    owners = dict(synonym.select(synonym.id, synonym.medical_term)
+                  .where(synonym.id.in_([syn_id for _, syn_id in term_pairs]))
+                  .tuples())
+    stale_ids = {term_id for term_id, syn_id in term_pairs if owners.get(syn_id) != term_id}
+    for term_id in stale_ids:
+        db.term_matcher.matcher.sync_term(term_id)
+
+    return [(term_id, syn_id) for term_id, syn_id in term_pairs if term_id not in stale_ids]
+
 
-        syn_id = db.data_models.MedicalTermSynonym.get(db.data_models.MedicalTermSynonym.synonym == term['term']).id
-        term_pairs.append((term_id, syn_id))
+def fill_term_urls(terms: list[dict], lan: str) -> None:
+    """
+    Fill in the URLs of the terms just created without one, once they are committed.
+    """
+    for term in terms:
+        if term.get('created') and term['explanation']['url'] is None:
+            fill_term_url(term['termId'], lan, term['term'], term['candidateUrl'])
+
+
+def fill_term_url(term_id: int, lan: str, name: str, candidate_url: str | None) -> None:
+    """
+    Check the candidate URL of a new term, or find another one, and store it, in a background task.
+    """
+
+    def task():
+        with db.connection_context():
+            url = db.message_op.fill_term_url(term_id, lan, name, candidate_url)
+        print_info(f'URL of term {term_id} ({name}): {url}')
+
+    socketio.start_background_task(task)
+
+
+def unique_term_pairs(term_pairs: list[(int, int)]) -> list[(int, int)]:
+    """
+    A message links to each term once. Keep the first synonym found for each term.
+    """
+    found = {}
+    for term_id, syn_id in term_pairs:
+        found.setdefault(term_id, syn_id)
 
-    return term_pairs
+    return list(found.items())
 
 
-def make_message(message_id: int, src_lan: str, target_lan: str) -> None:
+def make_message(message_id: int, src_lan: str, target_lan: str, languages: list[str] | None = None) -> None:
     """
-    After analyzing the terms, store the terms in the message cache
+    After analyzing the terms, store the translations, the terms and the message cache, in one transaction.
+    In the fan-out mode, languages are all the languages of the room: the message is translated into all of them by
+    one GPT call, and the terms are analyzed in target_lan.
+    If GPT is unavailable, the message is left without (some of) the enhancement, and is sent as it is.
     """
     msg_text = db.data_models.Message.get(db.data_models.Message.id == message_id).text
 
-    if src_lan != target_lan:
-        translation = GPT.translate_to(target_lan, msg_text)
-        db.data_models.MessageTranslationCache.create(
-            message=message_id,
-            language_code=target_lan,
-            translated_text=translation
+    translations = {}
+    term_pairs, terms = [], []
+    try:
+        target_lans = [lan for lan in dict.fromkeys([target_lan, *(languages or [])]) if lan != src_lan]
+        with db.released_connection():
+            translations = GPT.translate_to_many(target_lans, msg_text)
+        if src_lan != target_lan:
+            term_pairs, terms = analyze_terms(translations[target_lan], target_lan)
+        else:
+            # same language
+            term_pairs, terms = analyze_terms(msg_text, src_lan)
+    except GPT.UpstreamUnavailable as e:
+        print_info(f'Message {message_id} is not enhanced: {e}')
+
+    synonym_field = 'translated_synonym' if src_lan != target_lan else 'original_synonym'
+    with db.atomic():
+        rows = [
+            {'message': message_id, 'language_code': lan, 'translated_text': translation}
+            for lan, translation in translations.items() if translation is not None
+        ]
+        if rows:
+            db.data_models.MessageTranslationCache.insert_many(rows).execute()
+
+        stored_pairs, touched_ids = store_terms(terms, target_lan)
+        term_pairs = unique_term_pairs(current_term_pairs(term_pairs) + stored_pairs)
+        if term_pairs:
+            db.data_models.MessageTermCache.insert_many([
+                {'message': message_id, 'medical_term': term_id, synonym_field: syn_id}
+                for term_id, syn_id in term_pairs
+            ]).execute()
+
+    if touched_ids:
+        # Cached as stored: a new term without its URL yet is cached again once fill_term_urls finds it
+        db.message_op.refresh_terms(list(touched_ids))
+    fill_term_urls(terms, target_lan)
+
+
+def fan_out_languages(roomId: int) -> list[str] | None:
+    """
+    In the fan-out mode, all the languages of the room, to translate a message into. None otherwise.
+    """
+    return db.room_op.get_room_languages(roomId) if TRANSLATION_FAN_OUT else None
+
+
+def get_room_semaphore(roomId: int) -> BoundedSemaphore:
+    semaphore = roomSemaphores.get(roomId)
+    if semaphore is None:
+        semaphore = roomSemaphores.setdefault(roomId, BoundedSemaphore(ROOM_ENRICH_CONCURRENCY))
+
+    return semaphore
+
+
+def send_message(event: str, roomId: int, message_id: int, target_lan: str, languages: list[str] | None = None,
+                 skip_sid: str | None = None) -> None:
+    """
+    Send the message to the room in target_lan or, in the fan-out mode, to each language room in its language.
+    """
+    if not languages:
+        socketio.emit(event, db.message_op.get_message(roomId, message_id, target_lan), to=roomId, skip_sid=skip_sid)
+        return
+
+    for lan in languages:
+        socketio.emit(
+            event,
+            db.message_op.get_message(roomId, message_id, lan),
+            to=language_room(roomId, lan),
+            skip_sid=skip_sid
         )
-        translated_pairs = analyze_terms(translation, target_lan)
-        for term_pair in translated_pairs:
-            db.data_models.MessageTermCache.create(
-                message=message_id,
-                medical_term=term_pair[0],
-                translated_synonym=term_pair[1]
-            )
-    else:
-        # same language
-        term_pairs = analyze_terms(msg_text, src_lan)
-        for term_pair in term_pairs:
-            db.data_models.MessageTermCache.create(
-                message=message_id,
-                medical_term=term_pair[0],
-                original_synonym=term_pair[1]
-            )
 
 
-def chat_with_bot(session: dict, json: dict) -> int:
+def enrich_message(roomId: int, message_id: int, src_lan: str, target_lan: str, languages: list[str] | None = None,
+                   skip_sid: str | None = None) -> None:
+    """
+    Run make_message in a background task and send the enhanced message to the room as `message-enriched`.
+    At most ROOM_ENRICH_CONCURRENCY enrichments of the same room run at once.
+    """
+
+    def task():
+        # Wait for the room's turn before taking a connection
+        with get_room_semaphore(roomId), db.connection_context():
+            make_message(message_id, src_lan, target_lan, languages)
+
+        with db.connection_context():
+            send_message('message-enriched', roomId, message_id, target_lan, languages, skip_sid)
+
+    socketio.start_background_task(task)
+
+
+def forward_message(session: WsSession, message_id: int, target_lan: str, languages: list[str] | None = None) -> None:
     """
-    :return: message_id of the message generated by the bot
+    Pipeline mode: pass the raw message to the other users in the room at once, then enrich it in the background.
     """
+    roomId = session.room_id
+    send_message('message', roomId, message_id, target_lan, languages, skip_sid=session.sid)
+    enrich_message(roomId, message_id, session.language, target_lan, languages, skip_sid=session.sid)
+
 
-    global chatBots
-    roomId = session['roomId']
+def stream_bot_reply(chatBot: GPT.ChatBot, user_msg: str, roomId: int) -> tuple[str, str]:
+    """
+    Forward the bot reply to the room as `message-delta` events while it is being generated:
+    {
+        'streamId': 'c0ffee...',  # the same for all the deltas of a reply, and set in the final `message`
+        'roomId': 3,
+        'index': 0,  # order of the delta in the reply
+        'delta': 'How long'
+    }
+    If the stream breaks, `message-aborted` tells the room that no `message` will end it:
+    {
+        'streamId': 'c0ffee...',
+        'roomId': 3
+    }
+    :return: (stream id, the whole reply)
+    """
+    stream_id = uuid.uuid4().hex
+    pieces = []
+    try:
+        for piece in chatBot.chat_stream(user_msg):
+            emit('message-delta', {
+                'streamId': stream_id,
+                'roomId': roomId,
+                'index': len(pieces),
+                'delta': piece
+            }, to=roomId)
+            pieces.append(piece)
+            socketio.sleep(0)  # let the delta go out before waiting for the next one
+    except GPT.UpstreamUnavailable:
+        emit('message-aborted', {'streamId': stream_id, 'roomId': roomId}, to=roomId)
+        raise
+
+    return stream_id, ''.join(pieces)
+
+
+def chat_with_bot(session: WsSession, json: dict, user_message_id: int) -> int | None:
+    """
+    :param user_message_id: the saved message the bot replies to
+    :return: message_id of the message generated by the bot, or None if the bot is unavailable
+    """
+
+    roomId = session.room_id
     user_msg = json['text']
-    lan = session['user']['language']
+    lan = session.language
 
-    if chatBots.get(roomId) is None:
-        chatBots[roomId] = GPT.get_ai_doctor(lan)
-    chatBot = chatBots[roomId]
+    # The bot state lives in bot_states, so that any instance can answer the room
+    state = load_bot_state(roomId, lan, user_message_id)
+    chatBot = GPT.get_ai_doctor(state['language'])
+    chatBot.set_history(state['messages'])
 
-    bot_msg = chatBot.chat(user_msg)
+    stream_id = None
+    try:
+        with db.released_connection():
+            if STREAM_AI_DOCTOR:
+                stream_id, bot_msg = stream_bot_reply(chatBot, user_msg, roomId)
+            else:
+                bot_msg = chatBot.chat(user_msg)
+    except GPT.UpstreamUnavailable as e:
+        print_info(f'AI doctor unavailable in room {roomId}: {e}')
+        emit('error', {
+            'error': 'upstreamUnavailable',
+            'message': 'The AI doctor is temporarily unavailable. Please try again later.'
+        })
+        return None
 
+    bot_states.set(roomId, {'language': chatBot.lan, 'messages': chatBot.get_history()})
     message_id = db.message_op.save_message_only(0, roomId, bot_msg, datetime.now())
+    if ASYNC_PIPELINE:
+        emit('message', bot_message_data(roomId, message_id, lan, stream_id), to=roomId)
+        enrich_message(roomId, message_id, lan, lan)
+        return message_id
+
     make_message(message_id, lan, lan)
-    emit('message', db.message_op.get_message(roomId, message_id, lan), to=roomId)
+    emit('message', bot_message_data(roomId, message_id, lan, stream_id), to=roomId)
     return message_id
 
 
+def bot_message_data(roomId: int, message_id: int, lan: str, stream_id: str | None) -> dict:
+    data = db.message_op.get_message(roomId, message_id, lan)
+    if stream_id is not None:
+        data['streamId'] = stream_id
+
+    return data
+
+
 @socketio.on('message')
+@db.connection_context()
 def message(json: dict):
     """
     1. Get room stage.
@@ -217,10 +461,8 @@ def message(json: dict):
 
     """
 
-    global chatBots
-
     session = get_session()
-    roomId = session['roomId']
+    roomId = session.room_id
 
     if json.get('text') is None or json.get('timestamp') is None:
         emit('error', {
@@ -232,8 +474,8 @@ def message(json: dict):
     message_id = save_client_message(session, json['text'], json['timestamp'].split('Z')[0])
     emit(
         'message',
-        db.message_op.get_message(roomId, message_id, session['user']['language']),
-        to=session['sid']
+        db.message_op.get_message(roomId, message_id, session.language),
+        to=session.sid
     )
 
     """
@@ -241,34 +483,47 @@ def message(json: dict):
     doctor, target_lan should be the patient's lan.'
     """
     target_lan: str
-
-    if session['user']['type'] == 'PATIENT':
+    if session.user_type == 'PATIENT':
         doctors = db.room_op.get_room_doctor_ids(roomId)
         if len(doctors) == 0:
             # stage == 1
-            doctor_msg_id = chat_with_bot(session, json)
-            target_lan = session['user']['language']
+            doctor_msg_id = chat_with_bot(session, json, message_id)
+            target_lan = session.language
+            if doctor_msg_id is None or ASYNC_PIPELINE:
+                # The bot message is already in the room, and its enrichment is on the way
+                return
+            languages = fan_out_languages(roomId)
         else:
             # stage == 2, the user, patient, is chatting to a doctor.
             # This is the only situation where the backend only passes the received message to the room
 
-            # get doctor's language_code. Warning: Only handling the last joined doctor's language
+            # get doctor's language_code. Warning: Unless in the fan-out mode, only handling the last joined doctor's
+            # language. In the fan-out mode, the terms are still analyzed in that language
             target_lan = db.user_op.get_user_full(doctors[-1])['language']
+            languages = fan_out_languages(roomId)
 
-            make_message(message_id, session['user']['language'], target_lan)
+            if ASYNC_PIPELINE:
+                forward_message(session, message_id, target_lan, languages)
+                return
 
-            emit('message', db.message_op.get_message(roomId, message_id, target_lan), to=roomId, include_self=False)
+            make_message(message_id, session.language, target_lan, languages)
+
+            send_message('message', roomId, message_id, target_lan, languages, skip_sid=session.sid)
             return
     else:
         # User is a doctor
         doctor_msg_id = message_id
         patient_id = db.data_models.Room.get(db.data_models.Room.id == roomId).patient
         target_lan = db.data_models.BaseUser.get(db.data_models.BaseUser.id == patient_id).language_code
-        make_message(doctor_msg_id, session['user']['language'], target_lan)
+        languages = fan_out_languages(roomId)
+        if ASYNC_PIPELINE:
+            forward_message(session, message_id, target_lan, languages)
+            return
+
+        make_message(doctor_msg_id, session.language, target_lan, languages)
 
     # Forward enhanced message on to receiving client
-    data = db.message_op.get_message(roomId, doctor_msg_id, target_lan)
-    emit('message', data, to=roomId, include_self=False)
+    send_message('message', roomId, doctor_msg_id, target_lan, languages, skip_sid=session.sid)
 
 
 @socketio.on('ping-pong')
@@ -0,0 +1,22 @@
+# tests/conftest.py
+"""
+The tests run against a fresh SQLite database in a temporary directory, set up before src is imported, as src reads
+its settings and opens the database at import time.
+"""
+import os
+import sys
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix='heal-tests-')
+
+os.environ.update(
+    DB_PATH=os.path.join(TEST_DIR, 'heal.db'),
+    DATABASE_URL='',
+    CACHE_DB_PATH='',
+    PASSWORD_SALT='test',
+    OPENAI_API_KEY='test',
+    SOCKETIO_MESSAGE_QUEUE='',
+    BOT_STATE_URL='local',
+    INVALIDATION_URL='local'
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+# tests/test_analyze_terms.py
+import pytest
+
+from src import GPT, database, websocket
+from src.database.data_models import MedicalTerm, MedicalTermSynonym
+
+EXPLANATION = {'type': 'MEDICATION', 'description': 'A painkiller.', 'url': None}
+
+
+@pytest.fixture
+def japanese_term(monkeypatch):
+    """
+    A term known only by its Japanese synonym, which GPT gives as a synonym of an English term.
+    """
+    monkeypatch.setattr(GPT, 'analyze_medical_terms', lambda lan_code, text: [
+        {'term': 'painkillerx', 'synonyms': ['aspirinx'], 'explanation': dict(EXPLANATION)}
+    ])
+    monkeypatch.setattr(GPT, 'explain_analyzed_term', lambda lan_code, term, check_url=True: term['explanation'])
+    with database.connection_context():
+        term_id = MedicalTerm.create(term_type='MEDICATION').id
+        MedicalTermSynonym.create(medical_term=term_id, synonym='aspirinx', language_code='ja')
+        yield term_id
+        MedicalTerm.delete().where(MedicalTerm.id == term_id).execute()
+
+
+def test_owner_in_the_language_of_the_text(japanese_term):
+    with database.connection_context():
+        _, terms = websocket.analyze_terms('I took a painkillerx', 'ja')
+        assert terms[0]['termId'] == japanese_term
+
+        _, terms = websocket.analyze_terms('I took a painkillerx', 'en')
+        assert terms[0]['termId'] is None
@@ -0,0 +1,44 @@
+# tests/test_cache.py
+import os
+import threading
+import time
+
+from conftest import TEST_DIR
+
+from src.cache import LRUCache, PersistentCache
+
+
+def test_disk_hit_keeps_its_expiry():
+    path = os.path.join(TEST_DIR, 'expiry.db')
+    PersistentCache(path, 'test', ttl=0.5).set('key', 'value')
+    time.sleep(0.3)
+
+    # A new process: the entry is only on disk, and is promoted to memory for what is left of its TTL
+    cache = PersistentCache(path, 'test', ttl=0.5)
+    assert cache.get('key') == 'value'
+    time.sleep(0.3)
+    assert cache.memory.get('key') is None
+    assert cache.get('key') is None
+
+
+def test_counters_under_concurrency():
+    threads, gets = 8, 2000
+    memory = LRUCache(max_size=10)
+    persistent = PersistentCache('', 'test')
+    for cache in (memory, persistent):
+        cache.set('hit', 1)
+
+    def run():
+        for i in range(gets):
+            for cache in (memory, persistent):
+                cache.get('hit' if i % 2 else 'miss')
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for cache in (memory, persistent):
+        stats = cache.stats()
+        assert stats['hits'] == stats['misses'] == threads * gets // 2
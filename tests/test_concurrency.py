@@ -0,0 +1,64 @@
+# tests/test_concurrency.py
+"""
+Writers and readers of the same room at the same time, each with its own connection, as the request handlers and the
+background tasks are. Run with -s to see the throughput.
+"""
+import threading
+import time
+from datetime import datetime
+
+from peewee import OperationalError
+
+from src import database
+from src.database.data_models import db, Message, MessageTranslationCache
+from src.glovars import SQLITE_BUSY_TIMEOUT
+
+WRITERS, READERS, WRITES = 8, 8, 50
+
+
+def test_pragmas():
+    with database.connection_context():
+        assert db.execute_sql('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute_sql('PRAGMA busy_timeout').fetchone()[0] == SQLITE_BUSY_TIMEOUT
+        assert db.execute_sql('PRAGMA foreign_keys').fetchone()[0] == 1
+
+
+def test_concurrent_writers_and_readers():
+    errors = []
+    latencies = []
+    reads = []
+
+    def write(writer):
+        for i in range(WRITES):
+            start = time.perf_counter()
+            try:
+                with database.connection_context(), database.atomic():
+                    message = Message.create(room=1, user=1, text=f'{writer} {i}', send_time=datetime.now())
+                    MessageTranslationCache.create(message=message, language_code='ja', translated_text='-')
+            except OperationalError as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    def read():
+        while any(writer.is_alive() for writer in writers):
+            try:
+                with database.connection_context():
+                    database.message_op.get_chat_messages(1, 1, 20, 'en')
+                reads.append(1)
+            except OperationalError as e:
+                errors.append(e)
+
+    writers = [threading.Thread(target=write, args=(i,)) for i in range(WRITERS)]
+    readers = [threading.Thread(target=read) for _ in range(READERS)]
+    start = time.perf_counter()
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers + readers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f'\n{WRITERS * WRITES / elapsed:.0f} writes/s, {len(reads) / elapsed:.0f} reads/s, '
+          f'p99 write {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+    assert not errors
+    assert reads
@@ -0,0 +1,37 @@
+# tests/test_connections.py
+"""
+Database connections of the request handlers, the Socket.IO handlers and the blocks that give theirs back.
+"""
+from src import app, database, socketio
+from src.database.data_models import db, Message
+
+
+def test_rejected_socket_connection():
+    # The connect handler disconnects the client, running the disconnect handler within its own
+    client = socketio.test_client(app, auth={'token': 'invalid', 'roomId': 1})
+    assert not client.is_connected()
+    assert db.is_closed()
+
+
+def test_released_connection():
+    with database.connection_context():
+        Message.select().count()
+        with database.released_connection():
+            assert db.is_closed()
+        assert not db.is_closed()
+        Message.select().count()
+    assert db.is_closed()
+
+
+def test_nested_connection_contexts():
+    with database.connection_context():
+        with database.connection_context():
+            Message.select().count()
+        assert not db.is_closed()
+    assert db.is_closed()
+
+
+def test_http_request_closes_its_connection():
+    with app.test_client() as client:
+        client.get('/chats/1/messages', query_string={'limit': 1, 'page': 1})
+    assert db.is_closed()
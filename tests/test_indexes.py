@@ -0,0 +1,85 @@
+# tests/test_indexes.py
+"""
+Each hot query must be a SEARCH on its composite index, on a new database as well as on a migrated one.
+"""
+import re
+
+import pytest
+
+from src import database
+from src.database import migrations
+from src.database.data_models import (
+    db, Message, MessageTermCache, DoctorInRoom, SecondOpinionRequest, MedicalTermInfo, MedicalTermSynonym,
+    PatientCondition, PatientPrescription
+)
+
+# index -> query using it, as the database operations do
+HOT_QUERIES = {
+    'message_room_id_id': (Message.select(Message.id)
+                           .where((Message.room == 1) & (Message.id < 100))
+                           .order_by(Message.id.desc())
+                           .limit(20)),
+    'doctorinroom_room_id_enabled': (DoctorInRoom.select(DoctorInRoom.room)
+                                     .where(DoctorInRoom.room.in_([1, 2]) & (DoctorInRoom.enabled == True))),
+    'doctorinroom_doctor_id_enabled': (DoctorInRoom.select()
+                                       .where((DoctorInRoom.doctor == 2) & (DoctorInRoom.enabled == True))),
+    'secondopinionrequest_second_opinion_doctor_id_room_id': (SecondOpinionRequest.select(SecondOpinionRequest.room)
+                                                              .where(SecondOpinionRequest.second_opinion_doctor == 2)),
+    'medicalterminfo_approved_language_code': (MedicalTermInfo.select()
+                                               .where((MedicalTermInfo.approved == False) &
+                                                      (MedicalTermInfo.language_code == 'en'))),
+    'patientcondition_patient_id_medical_term_id': (PatientCondition.select()
+                                                    .where((PatientCondition.patient == 1) &
+                                                           (PatientCondition.medical_term == 3))),
+    'patientprescription_user_condition_id_medical_term_id': (PatientPrescription.select()
+                                                              .where((PatientPrescription.user_condition == 1) &
+                                                                     (PatientPrescription.medical_term == 3))),
+    'medicaltermsynonym_language_code_synonym': (MedicalTermSynonym.select()
+                                                 .where(MedicalTermSynonym.synonym.in_(['fever', 'cough']) &
+                                                        (MedicalTermSynonym.language_code == 'en'))),
+    'messagetermcache_message_id': MessageTermCache.select().where(MessageTermCache.message.in_([1, 2, 3])),
+}
+
+# Tables and columns of the indexes the migrations add
+MIGRATED_INDEXES = {
+    'message_room_id_id', 'doctorinroom_room_id_enabled', 'doctorinroom_doctor_id_enabled',
+    'secondopinionrequest_second_opinion_doctor_id_room_id', 'medicalterminfo_approved_language_code',
+    'patientcondition_patient_id_medical_term_id', 'patientprescription_user_condition_id_medical_term_id',
+    'medicaltermsynonym_language_code_synonym'
+}
+
+
+def query_plan(query) -> str:
+    sql, params = query.sql()
+    return '; '.join(row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params))
+
+
+@pytest.fixture
+def migrated_database():
+    """
+    The database as the schema before the migrations left it: without their indexes, and with them not applied.
+    """
+    with database.connection_context():
+        for index in MIGRATED_INDEXES:
+            db.execute_sql(f'DROP INDEX {index}')
+        migrations.SchemaMigration.delete().execute()
+
+    migrations.run()
+    with database.connection_context():
+        applied = [migration.version for migration in migrations.SchemaMigration.select()]
+    assert applied == [version for version, _, _ in migrations.MIGRATIONS]
+
+
+def check_plans():
+    with database.connection_context():
+        for index, query in HOT_QUERIES.items():
+            plan = query_plan(query)
+            assert re.search(rf'SEARCH \w+ USING (COVERING )?INDEX {index}\b', plan), f'{index}: {plan}'
+
+
+def test_new_database_uses_indexes():
+    check_plans()
+
+
+def test_migrated_database_uses_indexes(migrated_database):
+    check_plans()
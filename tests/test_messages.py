@@ -0,0 +1,46 @@
+# tests/test_messages.py
+import pytest
+
+from src import app, database
+
+
+@pytest.fixture
+def client():
+    with database.connection_context():
+        token = database.user.new_session_by_id(1)
+
+    with app.test_client() as client:
+        client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+        yield client
+
+
+@pytest.mark.parametrize('limit', ['0', '-1'])
+@pytest.mark.parametrize('cursor', [{'before': ''}, {'after': ''}, {'page': '1'}])
+def test_non_positive_limit_is_rejected(client, limit, cursor):
+    response = client.get('/chats/1/messages', query_string={'limit': limit, **cursor})
+    assert response.status_code == 400
+
+
+def test_pages_end_with_no_cursor(client):
+    with database.connection_context():
+        count = database.data_models.Message.select().where(database.data_models.Message.room == 1).count()
+
+    seen = []
+    cursor = ''
+    while cursor is not None:
+        response = client.get('/chats/1/messages', query_string={'limit': 2, 'before': cursor})
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page['messages']) <= 2
+        seen = page['messages'] + seen
+        cursor = page['nextCursor']
+
+    assert len(seen) == count
+    ids = [message['messageId'] for message in seen]
+    assert ids == sorted(set(ids))
+
+
+def test_empty_page_has_no_cursor():
+    with database.connection_context():
+        page = database.message_op.get_chat_messages_by_cursor(1, 0, 'en', before='')
+    assert page == {'messages': [], 'nextCursor': None}
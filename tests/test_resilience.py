@@ -0,0 +1,50 @@
+# tests/test_resilience.py
+import threading
+
+import pytest
+
+from src.GPT import resilience
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    monkeypatch.setattr(resilience, 'breaker', breaker)
+    return breaker
+
+
+def test_interrupted_trial_lets_the_next_one_through(breaker):
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        resilience.call_with_retry(interrupted)
+
+    assert resilience.call_with_retry(lambda: 'ok') == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_single_trial_when_half_open(breaker):
+    breaker.record_failure()
+    assert breaker.allow() == (True, True)
+    assert breaker.allow() == (False, False)
+
+
+def test_counts_every_call(breaker):
+    threads, calls = 8, 2000
+    before = resilience.get_metrics()['calls']
+
+    def run():
+        for _ in range(calls):
+            resilience.call_with_retry(lambda: None)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert resilience.get_metrics()['calls'] - before == threads * calls
@@ -0,0 +1,110 @@
+# tests/test_term_matcher.py
+import time
+
+import pytest
+
+from src import database
+from src.cache import LRUCache
+from src.database import message_op
+from src.database.data_models import MedicalTerm, MedicalTermSynonym
+from src.database.term_matcher import TermMatcher
+
+
+def create_term(*synonyms: str, language_code: str = 'en') -> int:
+    term_id = MedicalTerm.create(term_type='CONDITION').id
+    for synonym in synonyms:
+        MedicalTermSynonym.create(medical_term=term_id, synonym=synonym, language_code=language_code)
+    return term_id
+
+
+@pytest.fixture
+def terms():
+    """
+    Terms of their own, deleted afterwards, and a matcher loaded with them.
+    """
+    with database.connection_context():
+        ids = {
+            'blood': create_term('blood'),
+            'blood pressure': create_term('blood pressure'),
+            'high blood pressure': create_term('high blood pressure', 'hypertension'),
+            '糖尿病': create_term('糖尿病', language_code='ja'),
+            '頭痛': create_term('頭痛', language_code='ja'),
+        }
+        matcher = TermMatcher()
+        matcher.load()
+        yield matcher, ids
+        MedicalTerm.delete().where(MedicalTerm.id.in_(list(ids.values()))).execute()
+
+
+def found(matcher: TermMatcher, text: str) -> list[tuple[str, int]]:
+    return [(text[match.start:match.end], match.term_id) for match in matcher.find(text)]
+
+
+def test_longest_match_wins(terms):
+    matcher, ids = terms
+    assert found(matcher, 'Her High Blood Pressure is back') == [('High Blood Pressure', ids['high blood pressure'])]
+    assert found(matcher, 'blood pressure and blood tests') == [
+        ('blood pressure', ids['blood pressure']), ('blood', ids['blood'])
+    ]
+
+
+def test_word_boundaries(terms):
+    matcher, _ = terms
+    assert found(matcher, 'bloodless, bloody') == []
+
+
+def test_cjk_without_word_boundaries(terms):
+    matcher, ids = terms
+    assert found(matcher, '父は糖尿病で、頭痛もあります') == [('糖尿病', ids['糖尿病']), ('頭痛', ids['頭痛'])]
+
+
+def test_unknown_candidates(terms):
+    matcher, _ = terms
+    text = 'High blood pressure and a rash'
+    assert matcher.unknown_candidates(text, matcher.find(text)) == ['and', 'a', 'rash']
+
+    # Hiragana is grammar; the runs of kanji and katakana are candidates
+    text = '糖尿病と高脂血症でインスリンを使っています'
+    assert matcher.unknown_candidates(text, matcher.find(text)) == ['高脂血症', 'インスリン', '使']
+
+
+def test_learned_non_terms_are_not_candidates(terms):
+    matcher, _ = terms
+    text = 'a rash and a fever'
+    matcher.learn_non_terms(matcher.unknown_candidates(text, []), ['fever'])
+    assert matcher.unknown_candidates('a rash and a fever', []) == ['fever']
+
+
+def test_learned_non_terms_expire(terms):
+    matcher, _ = terms
+    matcher.non_terms = LRUCache(max_size=2, ttl=0.2)
+    matcher.learn_non_terms(['rash', 'itch', 'sore'], [])
+    assert matcher.unknown_candidates('rash itch sore', []) == ['rash']
+
+    time.sleep(0.3)
+    assert matcher.unknown_candidates('rash itch sore', []) == ['rash', 'itch', 'sore']
+
+
+def test_sync_term(terms):
+    matcher, ids = terms
+    with database.connection_context():
+        MedicalTermSynonym.create(medical_term=ids['blood'], synonym='haema', language_code='en')
+        matcher.sync_term(ids['blood'])
+    assert found(matcher, 'haema') == [('haema', ids['blood'])]
+
+    with database.connection_context():
+        MedicalTerm.delete().where(MedicalTerm.id == ids['blood']).execute()
+        matcher.sync_term(ids['blood'])
+    assert found(matcher, 'blood and haema') == []
+
+
+def test_deleted_terms_stop_matching(terms):
+    _, ids = terms
+    shared = database.term_matcher.matcher
+    with database.connection_context():
+        shared.sync_term(ids['high blood pressure'])  # if it was loaded before the term was created
+    assert [match.term_id for match in shared.find('hypertension')] == [ids['high blood pressure']]
+
+    with database.connection_context():
+        message_op.delete_term(ids['high blood pressure'])
+    assert shared.find('hypertension') == []
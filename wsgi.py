@@ -0,0 +1,6 @@
+# Production entry point, with SOCKETIO_ASYNC_MODE=gevent:
+#   gunicorn --worker-class gevent --workers 1 --worker-connections 10000 --bind 0.0.0.0:8888 wsgi:app
+# The gevent worker monkey patches the standard library before loading this module.
+from src import app
+
+__all__ = ['app']